@@ -1,59 +1,101 @@
 import pandas as pd
-import seaborn as sb
 import os
-import matplotlib
-matplotlib.use('Agg')  # this allows matplotlib to use different backend
-# that doesn't require GUI. Resolved threading issues
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
+import threading
+import offload
+from render_cache import cached_render, save_atomically
+from returns_panel import ReturnsPanel
+from moving_averages import add_moving_averages
+from universe_store import UniverseStore
+from instrumentation import timed
 
 os.environ['OPENBLAS_NUM_THREADS'] = '1'  # numpy and scikit-lear use OpenBLAS for math operations,
 # so limiting this to 1 thread will help it not interfere with flask
 
+_pyplot_lock = threading.Lock()   # pyplot keeps global figure state, so only one thread draws at a time
+OFFLOAD_MIN_CELLS = int(os.getenv('OFFLOAD_MIN_CELLS', '1000000'))   # smaller correlations stay on the request
+# thread, shipping them to the process pool would cost more than computing them
+
+
+def _plotting():
+    """pyplot and seaborn, imported on the first draw instead of at import time since together with scipy they
+    take over a second to load and most requests are served from the render cache"""
+    import matplotlib
+    matplotlib.use('Agg')  # this allows matplotlib to use different backend
+    # that doesn't require GUI. Resolved threading issues
+    import matplotlib.pyplot as plt
+    import seaborn as sb
+    return plt, sb
+
 
 def calc_daily_returns(df):
-    """find the daily returns for a single stock"""
-    df['daily returns'] = df['close'].pct_change()  # calculate the returns
-    return df['daily returns'].dropna()  # removing Nan values (i.e. the first row I think)
+    """find the daily returns for a single stock, without modifying df"""
+    daily_returns = df['close'].pct_change().rename('daily returns')  # calculate the returns
+    return daily_returns.dropna()  # removing Nan values (i.e. the first row I think)
+
+
+def returns_panel(dataframe_dict):
+    """
+    align a {ticker: dataframe} dict into one ReturnsPanel, pass the panel to several functions to reuse it.
+    a UniverseStore is already aligned, so its memory mapped close matrix is used directly
+    """
+    if isinstance(dataframe_dict, ReturnsPanel):
+        return dataframe_dict
+    if isinstance(dataframe_dict, UniverseStore):
+        return dataframe_dict.returns_panel()
+    return ReturnsPanel.from_frames(dataframe_dict)
+
+
+def _correlation(tickers, close):
+    return ReturnsPanel(tickers, None, close).correlation()
 
 
 def calc_correlation(dataframe_dict):
-    """return correl matrix from multiple stocks"""
-    returns_dict = {ticker: calc_daily_returns(df) for ticker, df in dataframe_dict.items()}  # creating dict with
-    # ticker as the key and the calculated returns dataframe for each value
-    returns_df = pd.DataFrame(returns_dict)  # turning the dict into a dataframe, so we can calc correl matrix
-    correl_matrix = returns_df.corr(method="pearson")  # calc correl matrix
-    return correl_matrix
+    """return correl matrix from multiple stocks (dict of dataframes, a ReturnsPanel or a UniverseStore)"""
+    panel = returns_panel(dataframe_dict)
+    if panel.close.size < OFFLOAD_MIN_CELLS:
+        return panel.correlation()  # pearson, pairwise over shared dates
+    return offload.run(_correlation, panel.tickers, panel.close)   # same, in the offload pool
 
 
 def calc_stdev(dataframe_dict):  # works the same way as the calc_correlation function above
     """return standard deviation of multiple stocks based on their returns"""
-    returns_dict = {ticker: calc_daily_returns(df) for ticker, df in dataframe_dict.items()}
-    returns_df = pd.DataFrame(returns_dict)
-    stdev_df = returns_df.std(axis=0, skipna=True, ddof=1, numeric_only=False)
+    stdev_df = returns_panel(dataframe_dict).stdev()
     return stdev_df
 
 
-def make_stdev_plot(series):
-    """make barplot showing company standard deviations"""
-    df = series.reset_index()  # converts series to a data frame
-    df.columns = ["Ticker", "Standard Deviation of Daily Returns"]  # renaming columns
-    sb.barplot(data=df, orient="v", x='Ticker', y='Standard Deviation of Daily Returns')  # create barplot
-    plt.tight_layout()  # Adjust the plot to ensure everything fits without overlapping
+def _locked_draw(draw, img_path, *args):
+    with _pyplot_lock:
+        save_atomically(img_path, draw, *args)   # in the job, so a render whose caller timed out is still kept
+
 
-    static_dir = os.path.join(os.getcwd(), 'static')
-    img_path = os.path.join(static_dir, 'stdev_plot.png')  # get hold of image path so it can be saved
+def _render(kind, data, params, draw, *args):
+    """
+    run draw(img_path, *args) through the render cache, in the offload pool when it's enabled. draw has to be a module
+    level function so the pool can import it. holds the pyplot lock since pyplot's global state isn't thread safe
+    """
+    def render(img_path):   # the image path names the render, so concurrent requests for it share one job
+        offload.run(_locked_draw, draw, img_path, *args, key=img_path)
+    return cached_render(kind, data, params, render)
 
+
+def _draw_stdev_plot(img_path, series):
+    plt, sb = _plotting()
+    df = series.reset_index()  # converts series to a data frame
+    df.columns = ["Ticker", "Standard Deviation of Daily Returns"]  # renaming columns
+    fig, ax = plt.subplots()
+    sb.barplot(data=df, orient="v", x='Ticker', y='Standard Deviation of Daily Returns', ax=ax)  # create barplot
     plt.tight_layout()  # prevents layout from overlapping
     plt.savefig(img_path, format='png', dpi=300)  # saving plot as an image to be used in flask app
-    plt.close()  # closing matplotlib figure to free up memory
+    plt.close(fig)  # closing matplotlib figure to free up memory
 
-    print(f"Plot saved to {img_path}")
-    return img_path
+
+@timed('make_stdev_plot')
+def make_stdev_plot(series):
+    """make barplot showing company standard deviations, returns image path relative to static folder"""
+    return _render('stdev', series, {'dpi': 300}, _draw_stdev_plot, series)
 
 
+@timed('prep_data_for_model')
 def prep_data_for_model(df):
     """prepares data to be used in the linear regression model"""
     df = df.copy()   # making copy to avoid messing with original
@@ -68,16 +110,24 @@ def prep_data_for_model(df):
     return df.dropna()    # removing NaN values
 
 
-def train_linreg_model(dataframe):
-    """trains linreg model"""
-    prepped_data = prep_data_for_model(dataframe)
+@timed('train_linreg_model')
+def train_linreg_model(dataframe, prepped=False):
+    """trains linreg model, pass prepped=True if dataframe already went through prep_data_for_model"""
+    return offload.run(_fit_linreg_model, dataframe, prepped)   # inline unless STOCKANALYZER_OFFLOAD=1
+
+
+def _fit_linreg_model(dataframe, prepped):
+    from sklearn.model_selection import train_test_split   # scikit-learn loads scipy, so only when training
+    from sklearn.linear_model import LinearRegression
+    prepped_data = dataframe if prepped else prep_data_for_model(dataframe)
     # using 20 day moving average and close price for model
     x = prepped_data[['20 day moving average', 'close']]  # declaring model x vars
     y = prepped_data['daily returns']  # attempting to predict the daily returns
 
-    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.25)  # Splitting the data into
-    # training and testing data with 75%-25% split.
+    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.25, shuffle=False)  # Splitting the data
+    # into training and testing data with 75%-25% split.
     # So 75% is for training and 25% is for testing. AI recommended this split
+    # shuffle=False keeps it time ordered (train on the past, test on the most recent rows) and reproducible
 
     model = LinearRegression()   # initialize model
 
@@ -92,17 +142,18 @@ def predict_returns(model, x):
     return model.predict(x)  # predict next day daily returns (the price change as a percentage)
 
 
-def prepare_data_for_plotting(df):
-    """Prepare data specifically for the 20-day moving average plot"""
+def prepare_data_for_plotting(df, windows=(('sma', 20),)):
+    """Prepare data for the moving average plots, 20-day by default (see moving_averages.parse_windows)"""
     plot_df = df.copy()  # making copy of df
     plot_df.index = pd.to_datetime(plot_df.index)  # make date column datetime
     plot_df.sort_index(inplace=True)   # sort by date
-    plot_df['20 day moving average'] = plot_df['close'].rolling(window=20).mean()  # calc 20 day moving average
+    plot_df = add_moving_averages(plot_df, windows)  # every window from one cumulative sum
     return plot_df.dropna()  # drop NaN values
 
 
-def make_20dayma_plot(prepped_data, title):
-    """Generate plot and return it as an image"""
+def _draw_20dayma_plot(img_path, prepped_data, title):
+    plt, sb = _plotting()
+    import matplotlib.dates as mdates
     fig, ax = plt.subplots(figsize=(15, 8))  # create figure and axis, and set size
     sb.lineplot(data=prepped_data, x=prepped_data.index, y=prepped_data['20 day moving average'], ax=ax)  # make plot
     ax.set_title(title)
@@ -124,49 +175,52 @@ def make_20dayma_plot(prepped_data, title):
     ax.set_xlim(prepped_data.index.min(), prepped_data.index.max())   # sets the x-axis
     # limits to follow date range of data
 
-    static_dir = os.path.join(os.getcwd(), 'static')
-    img_path = os.path.join(static_dir, 'goldmansachs20dayma.png')   # define img path to enable saving it
-
     plt.tight_layout()   # prevent layout overlapping
     plt.savefig(img_path, format='png', dpi=300)
     plt.close(fig)   # to free memory
 
-    print(f"Plot saved to {img_path}")
-    return img_path
 
+@timed('make_20dayma_plot')
+def make_20dayma_plot(prepped_data, title):
+    """Generate plot and return its image path relative to static folder"""
+    plotted = prepped_data[['20 day moving average']]   # the only column drawn
+    return _render('20dayma', plotted, {'title': title, 'dpi': 300}, _draw_20dayma_plot, plotted, title)
 
-def make_plot(columnx, columny, prepped_data, title):
-    """generate linreg plot and return it as an image"""
-    fig, ax = plt.subplots()  # create figure and set of axes to plot
-    sb.regplot(x=columnx, y=columny, data=prepped_data, order=2, ci=None, ax=ax)  # make scatter plot w regression line
-    plt.title(title)   # setting title name of plot
-    static_dir = os.path.join(os.getcwd(), 'static')
-    img_filename = 'live_linreg_plot.png'
-    img_path = os.path.join(static_dir, img_filename)  # getting img pathway so it can be saved
 
+def _draw_plot(img_path, columnx, columny, prepped_data, title):
+    plt, sb = _plotting()
+    fig, ax = plt.subplots()  # create figure and set of axes to plot
+    sb.regplot(x=columnx, y=columny, data=prepped_data, order=2, ci=None, ax=ax)  # scatter plot w regression line
+    ax.set_title(title)   # setting title name of plot
     plt.tight_layout()  # prevent layout overlapping
     plt.savefig(img_path, format='png', dpi=300)  # saving plot as an image to be used in flask app
     plt.close(fig)  # closing matplotlib figure to free up memory
 
-    print(f"Plot saved to {img_path}")
-    return img_filename
 
+@timed('make_plot')
+def make_plot(columnx, columny, prepped_data, title):
+    """generate linreg plot and return its image path relative to static folder"""
+    plotted = prepped_data[[columnx, columny]]
+    return _render('linreg', plotted, {'columnx': columnx, 'columny': columny, 'title': title, 'dpi': 300},
+                   _draw_plot, columnx, columny, plotted, title)
 
-def correl_heatmap(stock_data_dict):
-    """makes correlation heatmap and returns it as an image"""
-    correl_matrix = calc_correlation(stock_data_dict)  # get correlation of each stock with each other
-    heatmap = sb.heatmap(correl_matrix, annot=True, vmin=0, vmax=1, square=True, center=0, cmap='coolwarm')  # make
-    # heatmap of correlations with range being 0 to 1
-    plt.title("Correlation Heatmap of Daily Returns", fontsize=16)  # setting title name of plot
-    static_dir = os.path.join(os.getcwd(), 'static')
-    img_path = os.path.join(static_dir, 'correlation_heatmap.png')  # getting img pathway so it can be saved
 
+def _draw_correl_heatmap(img_path, correl_matrix):
+    plt, sb = _plotting()
+    fig, ax = plt.subplots()
+    sb.heatmap(correl_matrix, annot=True, vmin=0, vmax=1, square=True, center=0, cmap='coolwarm', ax=ax)  # make
+    # heatmap of correlations with range being 0 to 1
+    ax.set_title("Correlation Heatmap of Daily Returns", fontsize=16)  # setting title name of plot
     plt.tight_layout()  # prevent layout overlapping
     plt.savefig(img_path, format='png', dpi=300)   # saving plot as an image to be used in flask app
-    plt.close(heatmap)  # closing matplotlib figure to free up memory
+    plt.close(fig)  # closing matplotlib figure to free up memory
+
 
-    print(f"Plot saved to {img_path}")
-    return img_path
+@timed('correl_heatmap')
+def correl_heatmap(stock_data_dict):
+    """makes correlation heatmap and returns its image path relative to static folder"""
+    correl_matrix = calc_correlation(stock_data_dict)  # get correlation of each stock with each other
+    return _render('correlation', correl_matrix, {'dpi': 300}, _draw_correl_heatmap, correl_matrix)
 
 
 # if __name__ == "__main__":   # example usage
@@ -1,38 +1,124 @@
 import os.path
-from datetime import datetime, timedelta  # timedelta can be used for calculations involving time
-import functools   # used to preserve metadata of function (i.e. function name, docstring)
-
-
-def api_tracking():
-    track_file = "api_tracker.txt"   # defines file name
-    today = datetime.now().date()  # get today's date
-
-    if os.path.exists(track_file):   # check if file is there and if so adjust count based on date
-        with open(track_file, 'r') as file:
-            last_date, count = file.read().split(',')
-            last_date = datetime.strptime(last_date, '%Y-%m-%d').date()  # converts data string
-            # into a date object, so it can be used for comparison
-            count = int(count)
-
-        if today > last_date:    # if today is not the last recorded date, then reset the counter
-            count = 1
-        else:    # incrementing the count if it's the same day
-            count += 1
-    else:
-        count = 1    # if the file doesn't exist start the counter at 1
-
-    with open(track_file, 'w') as file:    # writing the data and count into the tracking file
-        file.write(f"{today}, {count}")
-
-    return count    # to be used in the limit checker
-
-
-def api_limit_checker(func):
-    @functools.wraps(func)   # used to preserve meta data of function, like name and docstring
-    def wrapper(*args, **kwargs):
-        call_count = api_tracking()   # using output from above
-        if call_count > 25:   # checking if limit has been exceeded
-            print("API limit of 25 calls per day exceeded")
-            return None   # carried out instead of making an API call
-        return func(*args, **kwargs)  # calls the original function being decorated
-    return wrapper
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from instrumentation import inc
+
+# AlphaVantage free tier is 5 calls a minute and 25 a day, override with env vars for paid keys
+CALLS_PER_MINUTE = int(os.getenv('AV_CALLS_PER_MINUTE', '5'))
+CALLS_PER_DAY = int(os.getenv('AV_CALLS_PER_DAY', '25'))
+LEDGER_PATH = os.getenv('API_LEDGER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        'api_ledger.sqlite3'))
+MINUTE = 60
+DAY = 24 * 60 * 60
+
+Budget = namedtuple('Budget', ['minute', 'day', 'retry_after'])   # calls left in each window, seconds until next slot
+
+
+def _key_id(api_key):
+    """the ledger stores a hash of the key rather than the key itself"""
+    return hashlib.sha256((api_key or '').encode()).hexdigest()[:16]
+
+
+class QuotaLedger:
+    """
+    sliding per-minute and per-day call windows for any number of API keys, stored in a SQLite WAL database
+    so every thread and every worker process shares the same counts. Reservations run in a BEGIN IMMEDIATE
+    transaction which makes check-and-increment atomic across processes.
+    """
+    def __init__(self, path=LEDGER_PATH, per_minute=CALLS_PER_MINUTE, per_day=CALLS_PER_DAY):
+        self.path = path
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.local = threading.local()
+        self.blocked_until = {}   # key id -> time before which we already know the key is out of budget
+
+    def _connection(self):
+        """one connection per thread and per process (connections can't cross a fork)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS api_calls (key TEXT NOT NULL, ts REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS api_calls_key_ts ON api_calls (key, ts)")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def _budget(self, conn, key_id, now):
+        """counts the calls in each window and works out when the next call would fit"""
+        minute_count, oldest_minute = conn.execute(
+            "SELECT COUNT(*), MIN(ts) FROM api_calls WHERE key = ? AND ts > ?", (key_id, now - MINUTE)).fetchone()
+        day_count, oldest_day = conn.execute(
+            "SELECT COUNT(*), MIN(ts) FROM api_calls WHERE key = ? AND ts > ?", (key_id, now - DAY)).fetchone()
+        retry_after = 0.0
+        if day_count >= self.per_day:
+            retry_after = oldest_day + DAY - now
+        elif minute_count >= self.per_minute:
+            retry_after = oldest_minute + MINUTE - now
+        return Budget(minute=max(self.per_minute - minute_count, 0), day=max(self.per_day - day_count, 0),
+                      retry_after=max(retry_after, 0.0))
+
+    def reserve(self, api_key=None):
+        """record one call for api_key if both windows have room, returns the Budget left after the call or None"""
+        key_id = _key_id(api_key)
+        now = time.time()
+        if self.blocked_until.get(key_id, 0) > now:   # known to be out of budget, skip the database
+            inc('stockanalyzer_api_quota_denied_total')
+            return None
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")   # takes the write lock so check-and-insert is atomic across processes
+        try:
+            conn.execute("DELETE FROM api_calls WHERE key = ? AND ts <= ?", (key_id, now - DAY))
+            budget = self._budget(conn, key_id, now)
+            if budget.retry_after > 0:
+                conn.execute("COMMIT")
+                # calls only ever get added, so nobody else can free up budget before this time
+                self.blocked_until[key_id] = now + budget.retry_after
+                inc('stockanalyzer_api_quota_denied_total')
+                return None
+            conn.execute("INSERT INTO api_calls (key, ts) VALUES (?, ?)", (key_id, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        inc('stockanalyzer_api_calls_total')
+        return Budget(minute=budget.minute - 1, day=budget.day - 1, retry_after=0.0)
+
+    def remaining(self, api_key=None):
+        """Budget left for api_key without using any of it"""
+        return self._budget(self._connection(), _key_id(api_key), time.time())
+
+
+class RateLimiter:
+    """hands out API keys to callers, waiting while every key's per-minute window is full"""
+    def __init__(self, ledger, api_keys=('',)):
+        self.ledger = ledger
+        self.api_keys = list(api_keys) or ['']
+
+    def remaining(self):
+        """Budget per key, so callers can decide how much work to schedule"""
+        return {key: self.ledger.remaining(key) for key in self.api_keys}
+
+    def acquire(self):
+        """
+        reserve a call on the key with the most daily budget left and return that key.
+        returns None straight away if every key is out of daily quota, since waiting hours for it isn't useful
+        """
+        while True:
+            budgets = self.remaining()
+            if all(budget.day == 0 for budget in budgets.values()):
+                return None
+            for key in sorted(budgets, key=lambda k: budgets[k].day, reverse=True):
+                if self.ledger.reserve(key) is not None:
+                    return key
+            waits = [budget.retry_after for budget in budgets.values() if budget.day > 0]
+            time.sleep(max(min(waits, default=1.0), 0.05))   # wait for the earliest key to free a slot
+
+
+ledger = QuotaLedger()
+
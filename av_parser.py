@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson   # optional, parses the ~1MB full history payload about twice as fast as the json module
+except ImportError:
+    orjson = None
+
+# turns AlphaVantage TIME_SERIES_DAILY responses straight into NumPy columns, oldest bar first:
+# datetime64[D] dates, float64 (or float32) open/high/low/close and int64 volume
+COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+PRICE_COLUMNS = COLUMNS[:4]
+JSON_FIELDS = ['1. open', '2. high', '3. low', '4. close', '5. volume']
+SERIES_KEY = 'Time Series (Daily)'
+
+
+def loads(body):
+    """decode a json response body (bytes or str) with orjson when it's installed"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _presort(dates, values):
+    """
+    AlphaVantage lists the newest bar first, so flipping is enough. vendor dumps that are already oldest first are
+    kept as they are, anything else gets a real sort (keeping the last row of a repeated date)
+    """
+    if len(dates) < 2 or (dates[1:] > dates[:-1]).all():
+        return dates, values
+    dates, values = dates[::-1], values[::-1]
+    if not (dates[1:] > dates[:-1]).all():
+        order = np.argsort(dates[::-1], kind='stable')   # back in file order, so "last" means last in the file
+        dates, values = dates[::-1][order], values[::-1][order]
+        last = np.append(dates[1:] != dates[:-1], True)
+        dates, values = dates[last], values[last]
+    return dates, values
+
+
+def _columns(dates, values, price_dtype):
+    """split the (rows, 5) float64 matrix into preallocated, contiguous, oldest first columns"""
+    dates, values = _presort(dates, values)
+    rows = len(dates)
+    prices = np.empty((len(PRICE_COLUMNS), rows), dtype=price_dtype)   # one block, a row per price column
+    prices[:] = values[:, :4].T
+    volume = np.empty(rows, dtype=np.int64)
+    volume[:] = values[:, 4]
+    columns = dict(zip(PRICE_COLUMNS, prices))
+    columns['volume'] = volume
+    return np.ascontiguousarray(dates), columns
+
+
+def parse_series(series, price_dtype=np.float64):
+    """
+    (dates, {column: array}) from the "Time Series (Daily)" dict, {date: {"1. open": "..", ...}}.
+    every value is read in one pass straight into a float64 buffer, no intermediate list or dataframe of strings.
+    fields are looked up by name in every bar, so a dump with its keys in another order can't swap columns
+    """
+    rows = len(series)
+    dates = np.fromiter(series, dtype='datetime64[D]', count=rows)
+    values = np.fromiter((bar[field] for bar in series.values() for field in JSON_FIELDS), dtype=np.float64,
+                         count=rows * len(JSON_FIELDS)).reshape(rows, len(JSON_FIELDS))
+    return _columns(dates, values, price_dtype)
+
+
+def _csv_layout(header):
+    """positions of the date, open, high, low, close and volume cells, AlphaVantage calls the date "timestamp"
+    and other vendors "Date" (extra columns such as adjusted close are skipped)"""
+    names = [name.strip().lower() for name in header.split(',')]
+    date = 'timestamp' if 'timestamp' in names else 'date'
+    try:
+        return [names.index(name) for name in [date] + COLUMNS]
+    except ValueError:
+        raise ValueError(f"unexpected csv header {header!r}") from None
+
+
+def parse_csv(text, price_dtype=np.float64):
+    """same as parse_series for a datatype=csv response, "timestamp,open,high,low,close,volume" then a row per bar"""
+    if isinstance(text, bytes):
+        text = text.decode()
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("empty csv")
+    layout = _csv_layout(lines[0])
+    rows = lines[1:]
+    if not rows:
+        return _columns(np.empty(0, dtype='datetime64[D]'), np.empty((0, len(COLUMNS))), price_dtype)
+    dates = np.loadtxt(rows, delimiter=',', usecols=layout[0], dtype='datetime64[D]', ndmin=1)
+    values = np.loadtxt(rows, delimiter=',', usecols=layout[1:], dtype=np.float64, ndmin=2)
+    return _columns(dates, values.reshape(len(rows), len(COLUMNS)), price_dtype)
+
+
+def to_frame(dates, columns):
+    """dataframe shaped like the cache's, with the same DatetimeIndex stock_cache.load builds from datetime64[D]"""
+    return pd.DataFrame(columns, index=pd.DatetimeIndex(dates), columns=COLUMNS, copy=False)
+
+
+def parse_daily(payload, price_dtype=np.float64):
+    """dataframe from a decoded TIME_SERIES_DAILY json payload or a csv body, None when it holds no bars"""
+    if isinstance(payload, (str, bytes)):
+        dates, columns = parse_csv(payload, price_dtype)
+    else:
+        series = payload.get(SERIES_KEY)
+        if not series:
+            return None
+        dates, columns = parse_series(series, price_dtype)
+    return to_frame(dates, columns) if len(dates) else None
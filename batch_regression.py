@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+FEATURES = ['20 day moving average', 'close']   # same model as analysis.train_linreg_model
+TARGET = 'daily returns'
+
+
+def stack_universe(prepped_dict):
+    """
+    stack {ticker: prepped dataframe} into padded arrays, each ticker's rows in date order starting at position 0.
+    returns tickers, x (tickers, rows, 2), y (tickers, rows) and the number of real rows per ticker
+    """
+    tickers = list(prepped_dict)
+    lengths = np.array([len(prepped_dict[ticker]) for ticker in tickers], dtype=np.int64)
+    rows = int(lengths.max()) if len(tickers) else 0
+    x = np.zeros((len(tickers), rows, len(FEATURES)))
+    y = np.zeros((len(tickers), rows))
+    for position, ticker in enumerate(tickers):
+        df = prepped_dict[ticker]
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+        for feature, name in enumerate(FEATURES):
+            x[position, :len(df), feature] = df[name].to_numpy(dtype=np.float64)
+        y[position, :len(df)] = df[TARGET].to_numpy(dtype=np.float64)
+    return tickers, x, y, lengths
+
+
+def _fit(x, y, weights):
+    """
+    least squares with intercept for every ticker at once, rows with weight 0 are ignored. tickers with fewer
+    training rows than coefficients (a new listing) get NaN instead of breaking the batched solve for the others
+    """
+    count = weights.sum(axis=1)
+    enough = count >= x.shape[2] + 1
+    safe_count = np.where(enough, count, 1.0)
+    x_mean = np.einsum('bt,bti->bi', weights, x) / safe_count[:, None]
+    y_mean = (weights * y).sum(axis=1) / safe_count
+    # centering first keeps the normal equations well conditioned, close and its moving average are nearly collinear
+    xc = (x - x_mean[:, None, :]) * weights[:, :, None]
+    yc = (y - y_mean[:, None]) * weights
+    xtx = np.matmul(xc.transpose(0, 2, 1), xc)
+    xtx[~enough] = np.eye(x.shape[2])   # placeholder so pinv has nothing to choke on, the rows are blanked below
+    xty = np.matmul(xc.transpose(0, 2, 1), yc[:, :, None])[:, :, 0]
+    coef = np.einsum('bij,bj->bi', np.linalg.pinv(xtx), xty)   # batched 2x2 solve, pinv also copes with singular
+    intercept = y_mean - (x_mean * coef).sum(axis=1)
+    coef[~enough] = np.nan
+    intercept[~enough] = np.nan
+    return intercept, coef
+
+
+def _r2(x, y, weights, intercept, coef):
+    """R^2 of each ticker's fit on the rows with weight 1"""
+    predicted = intercept[:, None] + np.einsum('bti,bi->bt', x, coef)
+    count = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y_mean = (weights * y).sum(axis=1) / count
+        ss_res = (weights * (y - predicted) ** 2).sum(axis=1)
+        ss_tot = (weights * (y - y_mean[:, None]) ** 2).sum(axis=1)
+        return np.where(count >= 2, 1 - ss_res / ss_tot, np.nan)   # undefined for a single test row
+
+
+def fit_universe(prepped_dict, test_size=0.25, n_splits=1):
+    """
+    fit 20 day moving average + close -> daily returns for every ticker in one vectorized pass.
+    with n_splits=1 the oldest rows train and the newest test_size share is held out (train_test_split with
+    shuffle=False). n_splits > 1 does expanding walk-forward folds like sklearn's TimeSeriesSplit and reports
+    the mean test R^2 with the coefficients of the last fold.
+    returns a dataframe indexed by ticker with intercept, coefficients, r2, n_train and n_test
+    """
+    tickers, x, y, lengths = stack_universe(prepped_dict)
+    position = np.arange(x.shape[1])[None, :]
+
+    if n_splits == 1:
+        n_test = np.ceil(lengths * test_size).astype(np.int64)
+        folds = [(lengths - n_test, n_test)]
+    else:
+        fold_size = lengths // (n_splits + 1)
+        folds = [(lengths - (n_splits - fold) * fold_size, fold_size) for fold in range(n_splits)]
+
+    scores = []
+    for train_end, n_test in folds:
+        train = (position < train_end[:, None]).astype(np.float64)
+        test = ((position >= train_end[:, None]) & (position < (train_end + n_test)[:, None])).astype(np.float64)
+        intercept, coef = _fit(x, y, train)
+        scores.append(_r2(x, y, test, intercept, coef))
+
+    table = pd.DataFrame({
+        'intercept': intercept,
+        f"coef {FEATURES[0]}": coef[:, 0],
+        f"coef {FEATURES[1]}": coef[:, 1],
+        'r2': np.mean(scores, axis=0),
+        'n_train': train_end,
+        'n_test': n_test,
+    }, index=pd.Index(tickers, name='ticker'))
+    return table
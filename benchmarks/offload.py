@@ -0,0 +1,103 @@
+"""
+latency of a cheap route while plots render, inline against the offload pool, run from the project folder:
+
+    python -m benchmarks.offload                  # 300 GET /api/returns while make_plot renders in a loop
+    python -m benchmarks.offload --requests 1000 --workers 2
+
+each mode runs in its own python process, since STOCKANALYZER_OFFLOAD is read when offload.py is imported. the
+universe is synthetic and seeded into a temp stock cache, nothing calls the API
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = {'inline': '0', 'offload pool': '1'}
+
+
+def percentiles(timings):
+    """(p50, p99, max) in milliseconds"""
+    timings = sorted(timings)
+    return tuple(value * 1000 for value in (timings[len(timings) // 2], timings[int(len(timings) * 0.99)],
+                                            timings[-1]))
+
+
+def run(requests):
+    """(idle, during renders) percentiles of GET /api/returns, for the mode set in the environment"""
+    from benchmarks.synthetic import make_universe
+    import analysis
+    import flask_app
+    import offload
+    import render_cache
+    import stock_cache
+    render_cache.RENDER_DIR = os.path.join(os.path.dirname(stock_cache.CACHE_DIR), 'renders')   # out of static/
+    universe = make_universe(tickers=4)
+    for ticker, df in universe.items():
+        stock_cache.save(ticker, df)
+    ticker = next(iter(universe))
+    prepped = analysis.prep_data_for_model(universe[ticker])
+    client = flask_app.app.test_client()
+    analysis.make_plot('20 day moving average', 'daily returns', prepped, 'warm up')   # imports, starts the pool
+
+    def cheap_route():
+        timings = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            client.get(f"/api/returns/{ticker}?points=200")
+            timings.append(time.perf_counter() - start)
+        return percentiles(timings)
+
+    idle = cheap_route()
+    stop = threading.Event()
+
+    def render_loop():
+        count = 0
+        while not stop.is_set():   # a new title each time, so every call is a real render
+            analysis.make_plot('20 day moving average', 'daily returns', prepped, f"bench {count}")
+            count += 1
+    renderer = threading.Thread(target=render_loop)
+    renderer.start()
+    try:
+        busy = cheap_route()
+    finally:
+        stop.set()
+        renderer.join()
+        offload.shutdown()
+    return idle, busy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cheap route latency while plots render")
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=1, help="offload pool processes (OFFLOAD_WORKERS)")
+    parser.add_argument('--only', help=argparse.SUPPRESS)   # set for the child process running a single mode
+    args = parser.parse_args(argv)
+
+    if args.only:
+        print(json.dumps(run(args.requests)))
+        return 0
+
+    print(f"{'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}  GET /api/returns")
+    for mode, enabled in MODES.items():
+        workdir = tempfile.mkdtemp(prefix='stockanalyzer-offload-')
+        env = dict(os.environ, STOCKANALYZER_OFFLOAD=enabled, OFFLOAD_WORKERS=str(args.workers),
+                   STOCK_CACHE_DIR=os.path.join(workdir, 'stock_cache'),
+                   API_LEDGER_PATH=os.path.join(workdir, 'api_ledger.sqlite3'))
+        command = [sys.executable, '-m', 'benchmarks.offload', '--only', mode, '--requests', str(args.requests)]
+        try:
+            completed = subprocess.run(command, capture_output=True, text=True, check=True, env=env)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        idle, busy = json.loads(completed.stdout.splitlines()[-1])
+        print(f"{idle[0]:8.2f} {idle[1]:8.2f} {idle[2]:8.2f}  {mode}, idle")
+        print(f"{busy[0]:8.2f} {busy[1]:8.2f} {busy[2]:8.2f}  {mode}, while make_plot renders")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+parse time and memory of a many ticker load, the old pandas path against av_parser, run from the project folder:
+
+    python -m benchmarks.parse                    # 1000 tickers of 25 years each
+    python -m benchmarks.parse --tickers 200 --format csv
+
+each ticker's response body is decoded and parsed into a dataframe and every frame is kept, like a full universe
+load. every parser runs in its own python process, so its peak memory (max RSS) isn't hidden by an earlier one
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import av_parser
+from benchmarks.synthetic import make_ohlcv, alpha_vantage_payload, alpha_vantage_csv
+
+
+def parse_with_pandas(body):
+    """what data.fetch_stock_df did before av_parser: dict of dicts of strings through DataFrame.from_dict"""
+    time_series_data = json.loads(body).get("Time Series (Daily)", {})
+    df = pd.DataFrame.from_dict(time_series_data, orient='index')
+    df.index = pd.to_datetime(df.index)
+    df = df.astype(float)
+    df.columns = ['open', 'high', 'low', 'close', 'volume']
+    df.sort_index(inplace=True)
+    return df
+
+
+PARSERS = {
+    'pandas from_dict (json module)': ('json', parse_with_pandas),
+    'av_parser float64 (json module)': ('json', lambda body: av_parser.parse_daily(json.loads(body))),
+    'av_parser float64': ('json', lambda body: av_parser.parse_daily(av_parser.loads(body))),
+    'av_parser float32': ('json', lambda body: av_parser.parse_daily(av_parser.loads(body), np.float32)),
+    'av_parser csv float64': ('csv', lambda body: av_parser.parse_daily(body)),
+    'av_parser csv float32': ('csv', lambda body: av_parser.parse_daily(body, np.float32)),
+}
+
+
+def make_bodies(variants, years, fmt):
+    """`variants` distinct response bodies, cycled over the tickers so payload generation doesn't dominate"""
+    frames = [make_ohlcv(years=years, seed=seed) for seed in range(variants)]
+    if fmt == 'csv':
+        return [alpha_vantage_csv(df).encode() for df in frames]
+    return [json.dumps(alpha_vantage_payload(f"SYN{seed}", df)).encode() for seed, df in enumerate(frames)]
+
+
+def run(name, bodies, tickers):
+    """(seconds, peak RSS growth in bytes, bytes held by the frames) for loading every ticker with one parser"""
+    fmt, parse = PARSERS[name]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    frames = [parse(bodies[position % len(bodies)]) for position in range(tickers)]
+    elapsed = time.perf_counter() - start
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024   # ru_maxrss is in KB on linux
+    in_frames = sum(int(df.memory_usage(index=True).sum()) for df in frames)
+    return elapsed, peak, in_frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AlphaVantage parse time and memory")
+    parser.add_argument('--tickers', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=25)
+    parser.add_argument('--variants', type=int, default=8, help="distinct payloads cycled over the tickers")
+    parser.add_argument('--format', choices=['json', 'csv', 'all'], default='all')
+    parser.add_argument('--filter', default='', help="only run parsers whose name contains this")
+    parser.add_argument('--only', help=argparse.SUPPRESS)   # set for the child process running a single parser
+    args = parser.parse_args(argv)
+
+    if args.only:
+        bodies = make_bodies(args.variants, args.years, PARSERS[args.only][0])
+        print(json.dumps(run(args.only, bodies, args.tickers)))
+        return 0
+
+    print(f"{args.tickers} tickers x {args.years} years, orjson {'on' if av_parser.orjson else 'not installed'}")
+    print(f"{'seconds':>8} {'peak MB':>9} {'frames MB':>10}  parser")
+    for name, (fmt, parse) in PARSERS.items():
+        if args.format not in (fmt, 'all') or args.filter not in name:
+            continue
+        command = [sys.executable, '-m', 'benchmarks.parse', '--only', name, '--tickers', str(args.tickers),
+                   '--years', str(args.years), '--variants', str(args.variants)]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        elapsed, peak, in_frames = json.loads(completed.stdout.splitlines()[-1])
+        print(f"{elapsed:8.2f} {peak / 2 ** 20:9.1f} {in_frames / 2 ** 20:10.1f}  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
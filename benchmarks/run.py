@@ -0,0 +1,287 @@
+"""
+benchmark harness for data.py, analysis.py, the flask routes and worker startup, run from the project folder:
+
+    python -m benchmarks.run                      # run everything and compare with benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline      # record the current timings as the new baseline
+    python -m benchmarks.run --filter plot --tickers 20 --years 10
+
+everything runs against synthetic data and a local stub of the AlphaVantage API, so no key or quota is used.
+exits with status 1 when a benchmark is slower than its baseline by more than --threshold
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.stub_server import StubAlphaVantage
+from benchmarks.synthetic import make_universe
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+NOISE_FLOOR = 0.001   # differences under a millisecond are never reported as regressions
+
+BENCHMARKS = []   # (name, function(ctx) returning run or (run, setup))
+
+
+def benchmark(name):
+    """register a benchmark, the decorated function gets the shared context and returns what to time"""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def measure(run, setup=None, repeat=5):
+    """time run() `repeat` times after one warm-up call, setup() runs untimed before every call"""
+    timings = []
+    for attempt in range(repeat + 1):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if attempt:   # first call is warm-up (imports, caches, page faults)
+            timings.append(elapsed)
+    return {'median': statistics.median(timings), 'min': min(timings), 'repeat': repeat}
+
+
+class Context:
+    """shared state: synthetic universe, stub server, temp folders and the repo modules wired to them"""
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='stockanalyzer-bench-')
+        self.stub = StubAlphaVantage(latency=args.latency, years=args.years).__enter__()
+        # point the repo at the stub and temp folders before its modules read their settings
+        os.environ['STOCK_CACHE_DIR'] = os.path.join(self.workdir, 'stock_cache')
+        os.environ['API_LEDGER_PATH'] = os.path.join(self.workdir, 'api_ledger.sqlite3')
+        os.environ['ALPHAVANTAGE_ENDPOINT'] = self.stub.endpoint
+        os.environ['AV_CALLS_PER_MINUTE'] = str(10 ** 6)
+        os.environ['AV_CALLS_PER_DAY'] = str(10 ** 9)
+
+        import analysis
+        import data
+        import render_cache
+        import stock_cache
+        render_cache.RENDER_DIR = os.path.join(self.workdir, 'renders')   # keep benchmark plots out of static/
+        self.analysis, self.data, self.render_cache, self.stock_cache = analysis, data, render_cache, stock_cache
+
+        self.universe = make_universe(tickers=args.tickers, years=args.years)
+        self.ticker = next(iter(self.universe))
+        self.df = self.universe[self.ticker]
+        self.prepped = analysis.prep_data_for_model(self.df)
+        for ticker, df in self.universe.items():   # seed the cache so route benchmarks don't hit the stub
+            stock_cache.save(ticker, df)
+
+    def clear_renders(self):
+        shutil.rmtree(self.render_cache.RENDER_DIR, ignore_errors=True)
+
+    def close(self):
+        self.stub.__exit__(None, None, None)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+@benchmark('data.fetch_stock_df (stub http + parse, full history)')
+def bench_fetch(ctx):
+    return lambda: ctx.data.fetch_stock_df('SYN0', 'full')
+
+
+@benchmark('data.get_stock_df (cache hit)')
+def bench_cache_hit(ctx):
+    return lambda: ctx.data.get_stock_df(ctx.ticker)
+
+
+@benchmark('data.get_multiple_stock_df (cold cache, stub quota)')
+def bench_multi_fetch(ctx):
+    from api_limit_checking import QuotaLedger, RateLimiter
+    tickers = [f"MULTI{i}" for i in range(ctx.args.fetch_tickers)]
+
+    def setup():
+        for ticker in tickers:
+            shutil.rmtree(os.path.join(ctx.stock_cache.CACHE_DIR, ticker), ignore_errors=True)
+        ledger = QuotaLedger(path=os.path.join(ctx.workdir, f"quota-{time.time_ns()}.sqlite3"),
+                             per_minute=ctx.args.quota, per_day=10 ** 9)
+        ctx.data.rate_limiter = RateLimiter(ledger, ctx.data.API_KEYS)
+
+    return (lambda: ctx.data.get_multiple_stock_df(tickers)), setup
+
+
+@benchmark('analysis.calc_correlation')
+def bench_correlation(ctx):
+    return lambda: ctx.analysis.calc_correlation(ctx.universe)
+
+
+@benchmark('analysis.calc_stdev')
+def bench_stdev(ctx):
+    return lambda: ctx.analysis.calc_stdev(ctx.universe)
+
+
+@benchmark('analysis.calc_correlation (memory mapped universe store)')
+def bench_store_correlation(ctx):
+    import universe_store
+    path = os.path.join(ctx.workdir, 'universe_store')
+    universe_store.write_store(((ticker, df.index.values.astype('datetime64[D]'),
+                                 {name: df[name].to_numpy() for name in df.columns})
+                                for ticker, df in ctx.universe.items()), path=path)
+    return lambda: ctx.analysis.calc_correlation(universe_store.UniverseStore(path))
+
+
+@benchmark('analysis.prep_data_for_model')
+def bench_prep(ctx):
+    return lambda: ctx.analysis.prep_data_for_model(ctx.df)
+
+
+@benchmark('analysis.train_linreg_model')
+def bench_train(ctx):
+    return lambda: ctx.analysis.train_linreg_model(ctx.prepped, prepped=True)
+
+
+@benchmark('batch_regression.fit_universe')
+def bench_fit_universe(ctx):
+    from batch_regression import fit_universe
+    prepped = {ticker: ctx.analysis.prep_data_for_model(df) for ticker, df in ctx.universe.items()}
+    return lambda: fit_universe(prepped)
+
+
+def _plot_benchmarks():
+    """each plot function timed cold (matplotlib renders) and warm (render cache hit)"""
+    plots = {
+        'analysis.make_plot': lambda ctx: ctx.analysis.make_plot('20 day moving average', 'daily returns',
+                                                                 ctx.prepped, 'bench'),
+        'analysis.make_20dayma_plot': lambda ctx: ctx.analysis.make_20dayma_plot(
+            ctx.analysis.prepare_data_for_plotting(ctx.df), 'bench'),
+        'analysis.make_stdev_plot': lambda ctx: ctx.analysis.make_stdev_plot(ctx.analysis.calc_stdev(ctx.universe)),
+        'analysis.correl_heatmap': lambda ctx: ctx.analysis.correl_heatmap(ctx.universe),
+    }
+    for name, plot in plots.items():
+        benchmark(f"{name} (render)")(lambda ctx, plot=plot: ((lambda: plot(ctx)), ctx.clear_renders))
+        benchmark(f"{name} (render cache hit)")(lambda ctx, plot=plot: (lambda: plot(ctx)))
+
+
+_plot_benchmarks()
+
+
+def _route_benchmarks():
+    """end to end latency through the flask test client"""
+    for path in ['/', '/20daymovingavg', '/correlation', '/stdev', '/linreg']:
+        def build(ctx, path=path):
+            import flask_app
+            flask_app.INTERESTED_STOCKS = list(ctx.universe)
+            client = flask_app.app.test_client()
+            return lambda: client.get(path)
+        benchmark(f"route GET {path}")(build)
+
+    def build_cold_linreg(ctx):
+        import flask_app
+        import json_api
+        import model_registry
+        client = flask_app.app.test_client()
+
+        def setup():
+            model_registry.clear()
+            json_api._bodies.clear()
+
+        def run():
+            client.get('/linreg')
+            client.get(f"/api/linreg/{flask_app.LINREG_TICKER}?points=1200")   # what the page's scatter fetches
+        return run, setup
+    benchmark('route GET /linreg + chart data (model retrain)')(build_cold_linreg)
+
+    def build_moving_average_page(ctx):
+        import flask_app
+        import json_api
+        import moving_averages
+        client = flask_app.app.test_client()
+        tickers = ','.join(ctx.universe)
+
+        def setup():
+            json_api._bodies.clear()
+            moving_averages._cache.clear()
+
+        def run():
+            client.get(f"/20daymovingavg?tickers={tickers}")
+            for ticker in ctx.universe:   # what the page's charts fetch
+                client.get(f"/api/movingavg/{ticker}?windows={moving_averages.DEFAULT_WINDOWS}&points=1200")
+        return run, setup
+    benchmark('route GET /20daymovingavg + chart data (4 windows per ticker, cold)')(build_moving_average_page)
+
+
+_route_benchmarks()
+
+
+@benchmark('startup: import flask_app (fresh interpreter)')
+def bench_startup(ctx):
+    from benchmarks.startup import run_once
+    return lambda: run_once('flask_app', importtime=False)
+
+
+@benchmark('startup: import flask_app + first GET /linreg (fresh interpreter)')
+def bench_startup_first_request(ctx):
+    from benchmarks.startup import run_once
+    return lambda: run_once('flask_app', '/linreg', importtime=False)
+
+
+def compare(results, baseline, threshold):
+    """names of benchmarks whose median got slower than baseline by more than threshold"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before and result['median'] > before['median'] * (1 + threshold) \
+                and result['median'] - before['median'] > NOISE_FLOOR:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="stockanalyzer benchmarks")
+    parser.add_argument('--tickers', type=int, default=4, help="synthetic tickers in the universe")
+    parser.add_argument('--years', type=int, default=25, help="years of daily bars per ticker")
+    parser.add_argument('--latency', type=float, default=0.0, help="stub server delay per response (seconds)")
+    parser.add_argument('--quota', type=int, default=600, help="client calls per minute for the multi-fetch case")
+    parser.add_argument('--fetch-tickers', type=int, default=8, help="tickers fetched in the multi-fetch case")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help="only run benchmarks whose name contains this")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown before flagging, 0.2 = 20%%")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    ctx = Context(args)
+    results = {}
+    try:
+        for name, build in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            built = build(ctx)
+            run, setup = built if isinstance(built, tuple) else (built, None)
+            results[name] = measure(run, setup, repeat=args.repeat)
+            print(f"{results[name]['median'] * 1000:10.2f} ms  {name}")
+    finally:
+        ctx.close()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    if args.save_baseline:
+        merged = dict(baseline.get('results', {}), **results)   # filtered runs only update their own entries
+        with open(args.baseline, 'w') as file:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'params': {'tickers': args.tickers, 'years': args.years}, 'results': merged},
+                      file, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name in regressions:
+        before, after = baseline['results'][name]['median'], results[name]['median']
+        print(f"REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
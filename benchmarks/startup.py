@@ -0,0 +1,82 @@
+"""
+worker startup cost, measured in fresh interpreters with python -X importtime, run from the project folder:
+
+    python -m benchmarks.startup                      # import flask_app, slowest modules by cumulative time
+    python -m benchmarks.startup --module analysis --top 30
+    python -m benchmarks.startup --request /linreg    # time to import the app and serve its first request
+
+every run starts a new python process so nothing is already imported or cached in memory
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imports the module, then optionally serves one request through the test client and prints the timings
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+module = __import__({module!r})
+imported = time.perf_counter()
+if {path!r}:
+    module.app.test_client().get({path!r})
+print(imported - start, time.perf_counter() - imported, file=sys.stdout)
+"""
+
+
+def parse_importtime(stderr):
+    """{module: (self seconds, cumulative seconds)} from the -X importtime lines"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return modules
+
+
+def run_once(module='flask_app', path='', env=None, importtime=True):
+    """(import seconds, first request seconds, {module: (self, cumulative)}) from one fresh interpreter"""
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        ['-c', _SCRIPT.format(module=module, path=path)]
+    completed = subprocess.run(command, cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=True)
+    import_seconds, request_seconds = map(float, completed.stdout.split()[-2:])
+    return import_seconds, request_seconds, parse_importtime(completed.stderr) if importtime else {}
+
+
+def measure(module='flask_app', path='', repeat=5, env=None):
+    """median import and first request time over `repeat` fresh interpreters, plus the last importtime table"""
+    runs = [run_once(module, path, env) for _ in range(repeat)]
+    return {'import': statistics.median(run[0] for run in runs),
+            'request': statistics.median(run[1] for run in runs),
+            'modules': runs[-1][2]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="stockanalyzer startup time")
+    parser.add_argument('--module', default='flask_app')
+    parser.add_argument('--request', default='', help="also time the first GET of this path, e.g. /linreg")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20, help="how many of the slowest imports to list")
+    parser.add_argument('--warmup', action='store_true', help="run with STOCKANALYZER_WARMUP=1")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, STOCKANALYZER_WARMUP='1' if args.warmup else '0')
+    result = measure(args.module, args.request, args.repeat, env)
+
+    print(f"slowest imports while starting{' and serving ' + args.request if args.request else ''}:")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    slowest = sorted(result['modules'].items(), key=lambda item: item[1][1], reverse=True)
+    for name, (self_seconds, cumulative) in slowest[:args.top]:
+        print(f"{cumulative * 1000:10.1f} ms {self_seconds * 1000:7.1f} ms  {name}")
+    print(f"\nimport {args.module}: {result['import'] * 1000:.1f} ms (median of {args.repeat})")
+    if args.request:
+        print(f"first GET {args.request}: {result['request'] * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
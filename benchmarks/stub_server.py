@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks.synthetic import make_ohlcv, alpha_vantage_payload, alpha_vantage_csv
+
+THROTTLE_NOTE = ("Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute "
+                 "and 25 calls per day.")
+
+
+class StubAlphaVantage:
+    """
+    local fake of the TIME_SERIES_DAILY endpoint. Every symbol gets a synthetic history, each response waits
+    `latency` seconds, and more than `per_minute` calls in a sliding minute get AlphaVantage's throttle note
+    (or a 429 with throttle_status=429). Use as a context manager, the endpoint url is in .endpoint
+    """
+    def __init__(self, latency=0.0, per_minute=None, years=25, throttle_status=200):
+        self.latency = latency
+        self.per_minute = per_minute
+        self.years = years
+        self.throttle_status = throttle_status
+        self.calls = deque()
+        self.throttled = 0
+        self.payloads = {}   # (symbol, outputsize, datatype) -> encoded body, built once per symbol
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}/query"
+
+    def _payload(self, symbol, outputsize, datatype='json'):
+        with self.lock:
+            key = (symbol, outputsize, datatype)
+            if key not in self.payloads:
+                df = make_ohlcv(years=self.years, seed=sum(map(ord, symbol)))
+                if outputsize == 'compact':
+                    df = df.iloc[-100:]
+                if datatype == 'csv':
+                    self.payloads[key] = alpha_vantage_csv(df).encode()
+                else:
+                    self.payloads[key] = json.dumps(alpha_vantage_payload(symbol, df)).encode()
+            return self.payloads[key]
+
+    def _over_quota(self):
+        if self.per_minute is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and self.calls[0] <= now - 60:
+                self.calls.popleft()
+            if len(self.calls) >= self.per_minute:
+                self.throttled += 1
+                return True
+            self.calls.append(now)
+            return False
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                symbol = query.get('symbol', ['SYN'])[0]
+                outputsize = query.get('outputsize', ['compact'])[0]
+                datatype = query.get('datatype', ['json'])[0]
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, content_type = 200, 'text/csv' if datatype == 'csv' else 'application/json'
+                if stub._over_quota():
+                    status, content_type = stub.throttle_status, 'application/json'   # notes are json either way
+                    body = json.dumps({"Note": THROTTLE_NOTE}).encode()
+                else:
+                    body = stub._payload(symbol, outputsize, datatype)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):   # keep benchmark output clean
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS_PER_YEAR = 252
+
+
+def make_ohlcv(years=25, seed=0, end='2024-07-15', start_price=100.0):
+    """random walk daily bars shaped like data.get_stock_df output (oldest first, float columns)"""
+    rng = np.random.default_rng(seed)
+    rows = int(years * TRADING_DAYS_PER_YEAR)
+    dates = pd.bdate_range(end=end, periods=rows)
+    close = start_price * np.exp(np.cumsum(rng.normal(0.0003, 0.02, rows)))
+    open_ = close * np.exp(rng.normal(0, 0.005, rows))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, rows)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, rows)))
+    volume = rng.integers(1_000_000, 50_000_000, rows).astype(float)
+    df = pd.DataFrame({'open': open_, 'high': high, 'low': low, 'close': close, 'volume': volume}, index=dates)
+    return df.round({'open': 4, 'high': 4, 'low': 4, 'close': 4})   # AlphaVantage sends 4 decimals
+
+
+def make_universe(tickers=4, years=25, seed=0):
+    """{ticker: dataframe} for `tickers` synthetic names (SYN0, SYN1, ...)"""
+    return {f"SYN{i}": make_ohlcv(years=years, seed=seed + i) for i in range(tickers)}
+
+
+def alpha_vantage_payload(ticker, df):
+    """the TIME_SERIES_DAILY json AlphaVantage would return for df (newest bar first)"""
+    series = {}
+    for date, row in zip(df.index[::-1].strftime('%Y-%m-%d'), df.to_numpy()[::-1]):
+        series[date] = {
+            "1. open": f"{row[0]:.4f}",
+            "2. high": f"{row[1]:.4f}",
+            "3. low": f"{row[2]:.4f}",
+            "4. close": f"{row[3]:.4f}",
+            "5. volume": f"{int(row[4])}",
+        }
+    return {
+        "Meta Data": {
+            "1. Information": "Daily Prices (open, high, low, close) and Volumes",
+            "2. Symbol": ticker,
+            "3. Last Refreshed": df.index[-1].strftime('%Y-%m-%d'),
+            "4. Output Size": "Full size",
+            "5. Time Zone": "US/Eastern",
+        },
+        "Time Series (Daily)": series,
+    }
+
+
+def alpha_vantage_csv(df):
+    """the TIME_SERIES_DAILY datatype=csv body AlphaVantage would return for df (newest bar first)"""
+    lines = ["timestamp,open,high,low,close,volume"]
+    for date, row in zip(df.index[::-1].strftime('%Y-%m-%d'), df.to_numpy()[::-1]):
+        lines.append(f"{date},{row[0]:.4f},{row[1]:.4f},{row[2]:.4f},{row[3]:.4f},{int(row[4])}")
+    return "\r\n".join(lines) + "\r\n"
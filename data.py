@@ -1,59 +1,183 @@
 import pandas as pd
-import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from dotenv import load_dotenv
 from api_limit_checking import *
+import av_parser
+import stock_cache
+import universe_store
+from instrumentation import span, cache_result, gauge, inc
 
 
 dotenv_path = os.path.join(os.path.dirname(__file__), 'key.env')   # specifies the path to my environment var
 load_dotenv(dotenv_path)  # loading my environment var
 
 API_KEY = os.getenv('apikey')
-ENDPOINT = "https://www.alphavantage.co/query"
+API_KEYS = [key.strip() for key in (API_KEY or '').split(',') if key.strip()] or ['']   # comma separated
+# in key.env to spread calls over several keys
+ENDPOINT = os.getenv('ALPHAVANTAGE_ENDPOINT', "https://www.alphavantage.co/query")
+MAX_RETRIES = 4   # retries when AlphaVantage says we're calling too fast
+BACKOFF_SECONDS = 2   # first retry waits this long, then doubles
+DATATYPE = os.getenv('ALPHAVANTAGE_DATATYPE', 'json')   # 'json' or 'csv', both parse straight into NumPy arrays
+PRICE_DTYPE = 'float32' if os.getenv('STOCK_PRICES_FLOAT32', '0') == '1' else 'float64'   # float32 halves the
+# memory of the price columns (about 7 significant digits, plenty for 4 decimal prices under $1000)
 
+session = None   # one pooled requests session so parallel fetches reuse connections, see get_session
+_session_lock = threading.Lock()
+rate_limiter = RateLimiter(ledger, API_KEYS)   # shared quota across threads and worker processes
+gauge('stockanalyzer_api_quota_remaining', lambda: {
+    (('key', key_position), ('window', window)): getattr(budget, window)
+    for key_position, budget in enumerate(rate_limiter.remaining().values()) for window in ('minute', 'day')
+})   # keys are labelled by position in key.env so they never show up in /metrics
 
-@api_limit_checker
-def get_stock_df(ticker):
+
+def remaining_budget():
+    """{api key: Budget} with the calls left in the current minute and day windows for every key in key.env"""
+    return rate_limiter.remaining()
+
+
+def get_session():
+    """the shared requests session, created on the first API call so a fully cached worker never imports requests"""
+    global session
+    with _session_lock:
+        if session is None:
+            import requests
+            pooled = requests.Session()
+            adapter_size = max(CALLS_PER_MINUTE, 10)
+            pooled.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=adapter_size))
+            pooled.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=adapter_size))
+            session = pooled
+        return session
+
+
+def _notice(json_data):
+    """AlphaVantage answers limited calls with a 200 and a 'Note'/'Information' message instead of data"""
+    return (json_data.get("Note") or json_data.get("Information") or "").lower()
+
+
+def is_throttled(response, json_data):
+    """called too fast: a 429/503 or the per minute 'call frequency' notice, worth retrying after a backoff"""
+    if response.status_code in (429, 503):
+        return True
+    return "frequency" in _notice(json_data)
+
+
+def is_daily_cap(json_data):
+    """the 'rate limit is 25 requests per day' notice, retrying only burns more quota until tomorrow"""
+    message = _notice(json_data)
+    return "rate limit" in message and "frequency" not in message
+
+
+def fetch_stock_df(ticker, outputsize="full"):
     """Makes API call to fetch stock data and returns it as dataframe"""
     parameters = {
             "function": "TIME_SERIES_DAILY",
             "symbol": ticker,
-            "outputsize": "full",
-            "apikey": API_KEY
+            "outputsize": outputsize,   # 'compact' is the latest 100 bars, 'full' is 20+ years
+            "datatype": DATATYPE,
         }
 
-    response = requests.get(ENDPOINT, params=parameters)  # making API call
+    for attempt in range(MAX_RETRIES + 1):
+        api_key = rate_limiter.acquire()   # records the call in the quota ledger, waits if the minute is full
+        if api_key is None:
+            print(f"Daily API quota used up, not fetching {ticker}")
+            return None
+        parameters["apikey"] = api_key
+        with span('alphavantage_request', outputsize=outputsize):   # network only, up to the last byte of the body
+            response = get_session().get(ENDPOINT, params=parameters)  # making API call
+            body = response.content if response.status_code == 200 else b''
+        with span('decode_response'):
+            # csv requests still get json back for errors and throttle notes
+            json_data = av_parser.loads(body) if body.lstrip()[:1] == b'{' else {}
+        if is_daily_cap(json_data):
+            inc('stockanalyzer_api_throttled_total', limit='day')
+            print(f"AlphaVantage daily limit reached, not fetching {ticker}")
+            return None
+        if not is_throttled(response, json_data):
+            break
+        inc('stockanalyzer_api_throttled_total', limit='minute')
+        if attempt < MAX_RETRIES:
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)   # exponential backoff before trying again
     response.raise_for_status()    # used for https errors
-    json_data = response.json()   # format to json
-    time_series_data = json_data.get("Time Series (Daily)", {})  # getting the time series data into dict
-    if not time_series_data:   # checking if API limit reached
+
+    with span('parse_time_series'):
+        payload = body if DATATYPE == 'csv' and not json_data else json_data
+        df = av_parser.parse_daily(payload, PRICE_DTYPE)   # sorted oldest first, int64 volume
+    if df is None:   # checking if API limit reached
         print(f"No data received for {ticker}. Might be due to reaching the API limit.")
         return None
+    return df
+
 
-    df = pd.DataFrame.from_dict(time_series_data, orient='index')  # convert to data frame
-    df.index = pd.to_datetime(df.index)   # making sure index treated as datetime
-    df = df.astype(float)  # Convert strings to floats
-    df.columns = ['open', 'high', 'low', 'close', 'volume']    # setting column names
-    df.sort_index(inplace=True)    # sorting the index from oldest at top to the newest on bottom
+def _seed_from_universe(ticker):
+    """
+    copy a ticker's history from the bulk ingested universe store into the cache, so a ticker we have never
+    downloaded only costs a compact call for the bars after the dump instead of a full one
+    """
+    store = universe_store.open_store()
+    if store is None or ticker not in store:
+        return None
+    df = store.frame(ticker)
+    if not len(df):
+        return None
+    # marked as checked at that day's close, so any later trading day still counts as missing
+    checked_at = datetime.combine(df.index[-1].date(), stock_cache.MARKET_CLOSE, tzinfo=stock_cache.MARKET_TZ)
+    stock_cache.save(ticker, df, checked_at=checked_at)
     return df
 
 
-@api_limit_checker
-def get_multiple_stock_df(tickers):
-    """calls get_stock_def() for each ticker and creates dict to map ticker to dataframe"""
-    parameters = {
-        "function": "TIME_SERIES_DAILY",
-        "symbol": tickers,
-        "outputsize": "full",
-        "apikey": API_KEY
-    }
-    dict_of_all_stock_df = {}
-    for ticker in tickers:   # creating dict with key being the ticker and
-        # value being the corresponding data frame holding stock data
-        time.sleep(16)  # api rate limit respect
-        df = get_stock_df(ticker)
-        dict_of_all_stock_df[ticker] = df   # setting value to be respective stock's dataframe
+def get_stock_df(ticker):
+    """returns daily stock data as dataframe, reading the local cache first and only fetching the missing tail"""
+    with stock_cache.ticker_lock(ticker):   # concurrent callers (threads or worker processes) wait for one download
+        cached = stock_cache.load(ticker)
+        if cached is None:
+            cached = _seed_from_universe(ticker)
+        if cached is not None and not stock_cache.is_stale(ticker):
+            cache_result('stock', hit=True)
+            return cached   # cache hit, no API call
+        cache_result('stock', hit=False)
+
+        outputsize = stock_cache.outputsize_needed(ticker)
+        fresh = fetch_stock_df(ticker, outputsize)
+        if fresh is None:   # API limit hit or no data, so fall back on whatever we already have
+            return cached
+
+        if outputsize == "full":
+            stock_cache.save(ticker, fresh)
+            return fresh
+        return stock_cache.append(ticker, fresh)   # compact fetch, so append the new bars onto the history
 
+
+def get_prepped_stock_df(ticker):
+    """
+    same frame prep_data_for_model(get_stock_df(ticker)) returns, but built from the indicator columns the cache
+    keeps updated bar by bar instead of recomputing rolling windows over the whole history
+    """
+    df = get_stock_df(ticker)
+    if df is None:
+        return None
+    indicators = stock_cache.load_indicators(ticker)
+    if indicators is None or not indicators.index.equals(df.index):   # cache unavailable, compute it from scratch
+        from analysis import prep_data_for_model
+        return prep_data_for_model(df)
+    return pd.concat([df, indicators], axis=1).dropna()
+
+
+def iter_multiple_stock_df(tickers, max_workers=None):
+    """fetch tickers in parallel and yield (ticker, dataframe) pairs as each one completes"""
+    max_workers = max_workers or max(CALLS_PER_MINUTE, 1)   # as many requests in flight as the quota allows
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(get_stock_df, ticker): ticker for ticker in tickers}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def get_multiple_stock_df(tickers):
+    """fetches every ticker and creates dict to map ticker to dataframe, in the same order as tickers"""
+    results = dict(iter_multiple_stock_df(tickers))
+    dict_of_all_stock_df = {ticker: results[ticker] for ticker in tickers}
     return dict_of_all_stock_df
 
 
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def _bucket_means(values, edges):
+    """nan-ignoring mean of values[edges[i]:edges[i + 1]] for every bucket, NaN for empty or all-NaN buckets"""
+    valid = ~np.isnan(values)
+    starts = np.minimum(edges[:-1], len(values) - 1)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    empty = edges[1:] <= edges[:-1]
+    counts[empty] = 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def lttb(y, points, x=None):
+    """
+    largest-triangle-three-buckets: indices of `points` rows that keep the visual shape of the y series.
+    first and last rows are always kept, every bucket in between contributes the row forming the largest
+    triangle with the previously picked row and the average of the next bucket
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n) if points >= n else np.array([0, n - 1][:max(points, 0)])
+    x = np.arange(n, dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+
+    every = (n - 2) / (points - 2)   # rows per bucket, first and last rows sit outside the buckets
+    edges = (np.arange(points - 1) * every).astype(np.int64) + 1   # bucket b covers edges[b]:edges[b + 1]
+    edges[-1] = n - 1
+    # averages of every bucket up front, bucket b looks at bucket b + 1 and the last bucket at the last row
+    next_x = _bucket_means(x, np.append(edges[1:], n))
+    next_y = _bucket_means(y, np.append(edges[1:], n))
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        px, py = x[previous], y[previous]
+        # twice the triangle area for every candidate in this bucket
+        areas = np.abs((px - next_x[bucket]) * (y[start:end] - py) - (px - x[start:end]) * (next_y[bucket] - py))
+        best = np.argmax(np.where(areas == areas, areas, -1.0)) if end > start else 0
+        previous = start + int(best)
+        selected[bucket + 1] = previous
+    return selected
+
+
+def minmax(y, points):
+    """indices of the min and max row of each of points/2 buckets (at least one), keeps every spike (returns)"""
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if points >= n:
+        return np.arange(n)
+    buckets = max(points // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    picks = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        window = y[start:end]
+        if np.isnan(window).all():
+            picks.append(start)
+            continue
+        picks.extend((start + int(np.nanargmin(window)), start + int(np.nanargmax(window))))
+    return np.unique(picks)
+
+
+def stride(n, points):
+    """every k-th row so roughly `points` rows remain (for scatter plots, where order carries no shape)"""
+    if points >= n or points < 1:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, points).astype(np.int64))
+
+
+METHODS = {'lttb': lttb, 'minmax': minmax}
+
+
+def downsample(y, points, method='lttb'):
+    """indices to keep for a time series using 'lttb' or 'minmax', all rows when points is 0/None"""
+    if not points:
+        return np.arange(len(y))
+    return METHODS[method](y, points)
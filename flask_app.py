@@ -1,21 +1,52 @@
-from flask import Flask, render_template, url_for
-from data import get_stock_df, get_multiple_stock_df
-from analysis import (make_plot, train_linreg_model, predict_returns,
-                      prep_data_for_model,)
 import os
 import os.path
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')   # this allows matplotlib to use different backend
-# that doesn't require GUI. Resolved threading issues
-
 os.environ['OPENBLAS_NUM_THREADS'] = '1'   # numpy and scikit-lear use OpenBLAS for math operations,
-# so limiting this to 1 thread will help it not interfere with flask
-
+# so limiting this to 1 thread will help it not interfere with flask (set before anything loads numpy)
+import click
+from flask import Flask, abort, jsonify, render_template, url_for, request
+from werkzeug.exceptions import ServiceUnavailable
+from render_cache import RENDER_SUBDIR
+from instrumentation import instrument_app, span
+from json_api import api
+import offload
+import scheduler
+# data, analysis and model_registry (pandas, requests, matplotlib, seaborn, scikit-learn) are imported inside the
+# views that need them, so a worker boots in a fraction of a second and pages built around static images never
+# load them. Set STOCKANALYZER_WARMUP=1 to load them, and the cached data and models, before serving instead
 
 INTERESTED_STOCKS = ["JPM", "GS", "BAC", "C"]
+LINREG_TICKER = "JPM"
+MAX_CHART_TICKERS = 20   # charts on one moving average page
+WARMUP = os.getenv('STOCKANALYZER_WARMUP', '0') == '1'
+RETRY_AFTER_SECONDS = 5   # told to clients turned away while the offload pool is full or a job runs long
 
 app = Flask(__name__, static_folder='static')   # create an instance of flask application
+instrument_app(app)   # request latency histograms, /metrics and X-Profile dumps
+app.config['INTERESTED_STOCKS'] = INTERESTED_STOCKS
+app.register_blueprint(api)   # json chart data under /api
+
+
+@app.after_request
+def cache_rendered_plots(response):
+    """rendered plots are content addressed (file name is a hash of the inputs), so browsers can keep them forever.
+    flask's static handler already adds the ETag and answers conditional GETs with 304"""
+    if request.path.startswith(f"/static/{RENDER_SUBDIR}/"):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    return response
+
+
+@app.errorhandler(offload.Busy)
+@app.errorhandler(offload.Timeout)
+def analysis_unavailable(error):
+    """
+    the offload pool is full, or the job is taking longer than OFFLOAD_TIMEOUT. a timed out job keeps running, a
+    render moves its image into the render cache itself and other results are kept for OFFLOAD_RESULT_TTL seconds, so
+    a retry after RETRY_AFTER_SECONDS waits on the same job or picks up what it made instead of starting over
+    """
+    return ServiceUnavailable(description=str(error), retry_after=RETRY_AFTER_SECONDS)
 
 
 @app.route("/")
@@ -27,31 +58,40 @@ def home():
 
 @app.route("/20daymovingavg")
 def moving_average():
-    """renders 20-day moving average plot images in flask"""
-    img_folder = os.path.join(os.getcwd(), "static", "moving_avg_images")  # define path to img folder where plots are
-    images = []
-    for img in os.listdir(img_folder):  # appending img pathways to a list
-        if img.lower().endswith('.png'):
-            img_path = 'moving_avg_images/' + img  # construct relative file path to image (plot)
-            img_path = img_path.lstrip('/')  # remove leading slash to ensure it's a relative file path
-            images.append(img_path)
+    """moving averages for ?tickers= and ?windows= (e.g. 20,50,200,ema20), drawn in the browser from /api/movingavg"""
+    import stock_cache
+    from moving_averages import DEFAULT_WINDOWS, column_name, parse_windows
+    tickers = [ticker.strip().upper() for ticker in request.args.get('tickers', ','.join(INTERESTED_STOCKS)).split(',')
+               if ticker.strip()]
+    if not 1 <= len(tickers) <= MAX_CHART_TICKERS or not all(map(stock_cache.is_valid_ticker, tickers)):
+        abort(400, description=f"give 1 to {MAX_CHART_TICKERS} valid tickers")
+    try:
+        windows = parse_windows(request.args.get('windows', DEFAULT_WINDOWS))
+    except ValueError as error:
+        abort(400, description=str(error))
+
+    window_param = ','.join(f"{kind}{window}" for kind, window in windows)
+    series = ','.join(['close'] + [column_name(kind, window) for kind, window in windows])
+    charts = [{'src': url_for('api.moving_average', ticker=ticker, windows=window_param), 'series': series,
+               'title': f"{ticker} moving averages"} for ticker in tickers]   # each chart fetches its own data
 
     return render_template(template_name_or_list='index.html', title='Stock Analysis',
                            header='Analyzing Major Bank Stocks',
-                           images=images,
-                           section_title='20-Day Moving Average Price',
-                           content='Presenting 20-day moving average price of JPMorgan, Goldman Sachs,'
-                                   ' Citigroup, and Bank of America. Time series data for the past 20 years is pulled'
+                           charts=charts,
+                           section_title='Moving Average Prices',
+                           content='Presenting simple and exponential moving average prices of JPMorgan, Goldman Sachs,'
+                                   ' Citigroup, and Bank of America (pick others with ?tickers=JPM,GS and the windows'
+                                   ' with ?windows=20,50,200,ema20). Time series data is pulled'
                                    ' from AlphaVantage free API. From this data,'
-                                   ' python scripts use the Pandas library '
-                                   ' to calculate the 20-day moving average price from 2000 - 2024. Visualizations are'
-                                   ' created with Seaborn and Matplotlib, then saved as images and rendered.')
+                                   ' every moving average is calculated in one pass with NumPy'
+                                   ' and drawn in the browser from the latest data.')
 
 
 @app.route("/correlation")
 def correlation():
-    """render correlation heatmap and commentary"""
-    image = "correlation_heatmap.png"
+    """correlation heatmap, drawn in the browser from /api/correlation, and commentary"""
+    charts = [{'kind': 'heatmap', 'src': url_for('api.correlation', tickers=','.join(INTERESTED_STOCKS)),
+               'title': "Correlation Heatmap of Daily Returns", 'height': 600}]
     sources = ['https://www.emarketer.com/content/citibank-shores-up-core-offerings-plan-shrink-mexico-footprint',
                'https://www.citigroup.com/global/news/perspective/2023/our-strategy-to-simplify-lessons-from-'
                'our-divestiture-journey-titi-cole']
@@ -67,20 +107,21 @@ def correlation():
                                    " markets across Asia and Europe - instead focusing on other higher-returning "
                                    "businesses. This shift from international markets may explain stark differences in"
                                    " Citigroup's correlation with the other three banks who maintain their "
-                                   "international presence. View sources below.", image=image)
+                                   "international presence. View sources below.", charts=charts)
 
 
 @app.route("/stdev")
 def standard_deviation():
-    """render barplot for standard deviation of daily returns for each stock"""
-    image = "stdev_plot.png"
+    """barplot for standard deviation of daily returns for each stock, drawn in the browser from /api/stdev"""
+    charts = [{'kind': 'bar', 'src': url_for('api.stdev', tickers=','.join(INTERESTED_STOCKS)), 'series': 'stdev',
+               'title': "Standard Deviation of Daily Returns"}]
     sources = ['https://www.forbes.com/sites/johnbuckingham/2024/04/17/volatility-price-of-successful-equity-'
                'investing--liking-citigroup/', 'https://internationalbanker.com/banking/major-restructuring-seeks-to-'
                                                'restore-citigroups-competitiveness-among-us-banking-elite/']
     return render_template('index.html', title='Stock Analysis',
                            header='Analyzing Major Bank Stocks',
                            section_title='Standard Deviation of Daily Returns',
-                           image=image,
+                           charts=charts,
                            sources=sources,
                            content="Citigroup's volatility is largely from restructuring efforts resulting in"
                                    " strategic shifts and cost-cutting measures. These efforts introduce short-term un"
@@ -92,40 +133,25 @@ def standard_deviation():
 
 @app.route("/linreg")
 def linear_regression():
-    """render live linear regression model in flask"""
-    ticker = "JPM"
-    jpm_df = get_stock_df(ticker)   # get historical stock data (Daily Time Series data)
-    prepped_jpm_df = prep_data_for_model(jpm_df)
-    model, score = train_linreg_model(prepped_jpm_df)
-    score = round(score, 4)   # formatting the r^2 value
-    latest_data = prepped_jpm_df.iloc[-1]   # getting last row which is the most recent line
-    x_vars = pd.DataFrame({   # getting hold of just the most recent data for interested columns
-        '20 day moving average': [latest_data['20 day moving average']],
-        'close': [latest_data['close']]
-    })
-
-    predicted_return = predict_returns(model, x_vars)[0]
-    predicted_return = round(predicted_return, 4)  # Predict the daily return using the model and most recent data
-# The model returns a numpy array, so we use [0] to extract the single predicted value
-# This converts the prediction from an array to a simple number (scalar)
-
-    plot_path = make_plot(columnx='20 day moving average', columny='daily returns',
-                          prepped_data=prepped_jpm_df, title="{ticker} Linear Regression")
-    # Generate a plot of the 20-day moving average vs daily returns
-# The plot is saved as an image file, and the file path is returned
-
-    latest_date = prepped_jpm_df.index[-1].strftime('%Y-%m-%d')  # getting hold of latest data to render in flask
-    latest_close = latest_data['close']  # getting hold of latest data to render in flask
-    latest_ma = latest_data['20 day moving average']  # getting hold of latest data to render in flask
+    """live linear regression model results, the scatter is drawn in the browser from /api/linreg"""
+    from data import get_prepped_stock_df
+    from model_registry import get_model
+    ticker = LINREG_TICKER
+    entry = scheduler.artifact(f"model:{ticker}")   # built after the close by the scheduler, when it runs
+    if entry is None:
+        prepped_jpm_df = get_prepped_stock_df(ticker)   # historical data plus indicators, kept up to date by the cache
+        entry = get_model(ticker, prepped_jpm_df, prepped=True, plot=False)   # fitted model, score and prediction
+    charts = [{'kind': 'scatter', 'src': url_for('api.linear_regression', ticker=ticker),
+               'title': f"{ticker} Linear Regression (20 day moving average vs daily returns)"}]
 
     return render_template('index.html', title='Linear Regression Model and Graphic',
                            header='Linear Regression of JPMorgan',
                            section_title='Live Model Results',
-                           score=score,
-                           last_date=latest_date,
-                           last_ma=latest_ma,
-                           latest_close=latest_close,
-                           predicted_return=predicted_return,
+                           score=entry.score,
+                           last_date=entry.latest_date,
+                           last_ma=entry.latest_ma,
+                           latest_close=entry.latest_close,
+                           predicted_return=entry.predicted_return,
                            content=f"This model uses JPMorgan's historical calculated 20-day moving average price and"
                                    f" closing price to learn patterns and make predictions of daily returns."
                                    f" The predicted return is the model's estimate of the next day's price"
@@ -133,7 +159,62 @@ def linear_regression():
                                    f" well the model explains the variability of the data. "
                                    f"While the R^2 of this model is low,"
                                    f" it provides a great platform for which to improve upon. ",
-                           image=plot_path)
+                           charts=charts)
+
+
+@app.route("/jobs")
+def jobs():
+    """status of the end of day scheduler and each of its nodes"""
+    return jsonify(scheduler.status())
+
+
+def warm_up(fetch=False):
+    """
+    import the analysis stack, load every cached ticker and fit the /linreg model so the first request isn't the
+    slow one. Without fetch only data that is already cached and up to date is used (no API calls), with fetch stale
+    tickers are refreshed first. Returns the tickers that were loaded
+    """
+    with span('warm_up'):
+        import stock_cache
+        from data import get_stock_df, get_prepped_stock_df
+        from model_registry import get_model
+
+        loaded = []
+        for ticker in INTERESTED_STOCKS:
+            if fetch or not stock_cache.is_stale(ticker):
+                if get_stock_df(ticker) is not None:
+                    loaded.append(ticker)
+        if LINREG_TICKER in loaded:
+            get_model(LINREG_TICKER, get_prepped_stock_df(LINREG_TICKER), background=False, prepped=True, plot=False)
+        return loaded
+
+
+@app.cli.command('warmup')
+@click.option('--fetch', is_flag=True, help="refresh stale tickers from AlphaVantage (uses API quota)")
+def warmup_command(fetch):
+    """fill the stock cache and render cache ahead of time, e.g. in a deploy step"""
+    loaded = warm_up(fetch=fetch)
+    click.echo(f"warmed up {', '.join(loaded) or 'nothing (cache empty or stale, try --fetch)'}")
+
+
+@app.cli.command('refresh')
+def refresh_command():
+    """run the end of day refresh once in the foreground (for cron instead of STOCKANALYZER_SCHEDULER=1)"""
+    runner = scheduler.Scheduler(INTERESTED_STOCKS, [LINREG_TICKER])
+    if not runner.acquire_leadership():
+        raise click.ClickException("another process is already scheduling the refresh (see /jobs)")
+    counts = runner.run()
+    for name, status in runner.status()['nodes'].items():
+        click.echo(f"{status['state']:>10}  {name}  {status.get('error') or ''}")
+    click.echo(', '.join(f"{count} {state}" for state, count in sorted(counts.items())))
+
+
+if WARMUP:   # runs at import, so gunicorn and flask run only start accepting requests once it's done
+    warm_up()
+
+if scheduler.ENABLED:   # rebuilds the pages' data, models and plots after every close, status at /jobs. with
+    # several workers only the one holding scheduler.LOCK_PATH runs it, the others serve what it published
+    scheduler.start(INTERESTED_STOCKS, [LINREG_TICKER])
 
 
 if __name__ == "__main__":
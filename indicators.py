@@ -0,0 +1,114 @@
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+SMA_WINDOW = 20
+INDICATOR_COLUMNS = ['daily returns', '20 day moving average', 'previous day close']   # same names as prep_data_for_model
+
+
+class IndicatorState:
+    """
+    rolling state for one ticker: the last `window` closes in a ring buffer plus the running sums pandas keeps
+    in its rolling mean (Kahan compensated sum, observation and negative counts, run length of equal values).
+    Replaying pandas' add/remove steps in the same order makes every update bit-for-bit equal to
+    close.rolling(window).mean(), close.pct_change() and close.shift(1) over the full history, in O(1) per bar.
+    """
+    def __init__(self, window=SMA_WINDOW):
+        self.window = window
+        self.buffer = deque(maxlen=window)   # closes currently inside the window
+        self.bars = 0   # bars seen so far
+        self.nobs = 0
+        self.sum_x = 0.0
+        self.compensation_add = 0.0
+        self.compensation_remove = 0.0
+        self.neg_ct = 0
+        self.num_consecutive_same_value = 0
+        self.prev_value = math.nan
+        self.last_close = math.nan
+
+    def _reset(self, first_value):
+        self.nobs = self.neg_ct = self.num_consecutive_same_value = 0
+        self.sum_x = self.compensation_add = self.compensation_remove = 0.0
+        self.prev_value = first_value
+
+    def _add(self, val):
+        if val == val:   # NaN closes are skipped, same as pandas
+            self.nobs += 1
+            y = val - self.compensation_add
+            t = self.sum_x + y
+            self.compensation_add = t - self.sum_x - y
+            self.sum_x = t
+            if math.copysign(1.0, val) < 0:
+                self.neg_ct += 1
+            if val == self.prev_value:   # pandas tracks runs of equal values to return them exactly
+                self.num_consecutive_same_value += 1
+            else:
+                self.num_consecutive_same_value = 1
+            self.prev_value = val
+
+    def _remove(self, val):
+        if val == val:
+            self.nobs -= 1
+            y = -val - self.compensation_remove
+            t = self.sum_x + y
+            self.compensation_remove = t - self.sum_x - y
+            self.sum_x = t
+            if math.copysign(1.0, val) < 0:
+                self.neg_ct -= 1
+
+    def _mean(self):
+        if self.nobs < self.window or self.nobs == 0:
+            return math.nan
+        result = self.sum_x / self.nobs
+        if self.num_consecutive_same_value >= self.nobs:
+            return self.prev_value
+        if self.neg_ct == 0 and result < 0:
+            return 0.0
+        if self.neg_ct == self.nobs and result > 0:
+            return 0.0
+        return result
+
+    def update(self, close):
+        """push one new bar, returns (daily return, 20 day moving average, previous day close) for it"""
+        close = float(close)
+        if self.bars == 0 or self.window == 1:   # pandas starts a fresh sum on the first window (every row for w=1)
+            self.buffer.clear()
+            self._reset(close)
+        elif len(self.buffer) == self.window:
+            self._remove(self.buffer[0])   # pandas removes the value leaving the window before adding the new one
+        self._add(close)
+        self.buffer.append(close)
+
+        previous_close = self.last_close
+        with np.errstate(divide='ignore', invalid='ignore'):
+            daily_return = float(np.float64(close) / np.float64(previous_close) - 1)
+        self.last_close = close
+        self.bars += 1
+        return daily_return, self._mean(), previous_close
+
+    def update_many(self, closes):
+        """push several bars in order, returns an (n, 3) array with one row of indicators per bar"""
+        return np.array([self.update(close) for close in closes], dtype=np.float64).reshape(-1, 3)
+
+    def to_dict(self):
+        """checkpoint that can be saved as json next to the cached bars"""
+        state = dict(vars(self))
+        state['buffer'] = list(self.buffer)
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """restore a checkpoint made by to_dict"""
+        indicator_state = cls(state['window'])
+        for name, value in state.items():
+            if name != 'buffer':
+                setattr(indicator_state, name, value)
+        indicator_state.buffer.extend(state['buffer'])
+        return indicator_state
+
+
+def indicator_frame(values, index):
+    """wrap the rows returned by update_many in a dataframe with prep_data_for_model's column names"""
+    return pd.DataFrame(values, index=index, columns=INDICATOR_COLUMNS)
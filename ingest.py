@@ -0,0 +1,131 @@
+"""
+bulk load vendor dumps into the memory mapped universe store (see universe_store.py), run from the project folder:
+
+    python ingest.py dumps/                       # every .csv/.json (optionally .gz) file under dumps/
+    python ingest.py JPM.csv GS.json --float32    # float32 prices, half the size of the price matrices
+    python ingest.py --from-cache                 # the tickers already downloaded into stock_cache/
+    python ingest.py dumps/ --replace             # drop whatever the store held before
+
+csv files need a header with timestamp (or date), open, high, low, close and volume columns, json files are
+AlphaVantage TIME_SERIES_DAILY responses. the ticker comes from the json meta data or else from the file name
+(JPM.csv, brk.b.json.gz). nothing here touches the API or its quota
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import av_parser
+import stock_cache
+import universe_store
+
+EXTENSIONS = ('.csv', '.json')
+
+
+def find_files(paths):
+    """files with a supported extension, folders are searched recursively"""
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().removesuffix('.gz').endswith(EXTENSIONS):
+                        yield os.path.join(folder, name)
+        else:
+            yield path
+
+
+def _ticker_from_name(file_path):
+    name = os.path.basename(file_path)
+    name = name[:-3] if name.lower().endswith('.gz') else name
+    return os.path.splitext(name)[0].upper()
+
+
+def parse_file(file_path, price_dtype='float64'):
+    """(ticker, dates, columns) for one dump file, or (file_path, None, error message) if it can't be used"""
+    try:
+        opener = gzip.open if file_path.lower().endswith('.gz') else open
+        with opener(file_path, 'rb') as file:
+            body = file.read()
+        ticker = _ticker_from_name(file_path)
+        if body.lstrip()[:1] == b'{':
+            payload = av_parser.loads(body)
+            ticker = payload.get('Meta Data', {}).get('2. Symbol', ticker).upper()
+            if not payload.get(av_parser.SERIES_KEY):
+                return file_path, None, "no time series in file"
+            dates, columns = av_parser.parse_series(payload[av_parser.SERIES_KEY], price_dtype)
+        else:
+            dates, columns = av_parser.parse_csv(body, price_dtype)
+    except (OSError, ValueError) as error:
+        return file_path, None, str(error)
+    if not stock_cache.is_valid_ticker(ticker):
+        return file_path, None, f"invalid ticker {ticker!r}"
+    if not len(dates):
+        return file_path, None, "no bars"
+    return ticker, dates, columns
+
+
+def _parse_args(item):
+    return parse_file(*item)
+
+
+def from_files(files, price_dtype='float64', workers=None):
+    """parse the files in a process pool and yield the usable ones, reporting the rest"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for ticker, dates, columns in pool.map(_parse_args, [(file_path, price_dtype) for file_path in files],
+                                               chunksize=16):
+            if dates is None:
+                print(f"skipped {ticker}: {columns}")
+                continue
+            yield ticker, dates, columns
+
+
+def from_cache():
+    """every ticker in stock_cache/ as (ticker, dates, columns)"""
+    if not os.path.isdir(stock_cache.CACHE_DIR):
+        return
+    for ticker in sorted(os.listdir(stock_cache.CACHE_DIR)):
+        if not stock_cache.is_valid_ticker(ticker):
+            continue
+        df = stock_cache.load(ticker)
+        if df is not None and len(df):
+            yield ticker, df.index.values.astype('datetime64[D]'), {name: df[name].to_numpy() for name in df.columns}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bulk load daily bar dumps into the universe store")
+    parser.add_argument('paths', nargs='*', help="csv/json files or folders of them")
+    parser.add_argument('--store', default=universe_store.UNIVERSE_DIR, help="store folder (STOCK_UNIVERSE_DIR)")
+    parser.add_argument('--float32', action='store_true', help="store prices as float32")
+    parser.add_argument('--replace', action='store_true', help="start from an empty store instead of merging")
+    parser.add_argument('--from-cache', action='store_true', help="also load every ticker in stock_cache/")
+    parser.add_argument('--workers', type=int, default=None, help="parser processes (default: one per cpu)")
+    args = parser.parse_args(argv)
+    if not args.paths and not args.from_cache:
+        parser.error("give files or folders to ingest, or --from-cache")
+
+    price_dtype = 'float32' if args.float32 else 'float64'
+    files = list(find_files(args.paths))
+    count = [0]
+
+    def items():
+        sources = [from_files(files, price_dtype, args.workers)] if files else []
+        if args.from_cache:
+            sources.append(from_cache())
+        for source in sources:
+            for item in source:
+                count[0] += 1
+                if count[0] % 500 == 0:
+                    print(f"parsed {count[0]} tickers")
+                yield item
+
+    start = time.perf_counter()
+    meta = universe_store.write_store(items(), path=args.store, price_dtype=price_dtype, replace=args.replace)
+    print(f"ingested {count[0]} tickers in {time.perf_counter() - start:.1f}s, store now holds "
+          f"{len(meta['tickers'])} tickers x {meta['rows']} dates ({meta['first_date']} to {meta['last_date']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import cProfile
+import functools
+import math
+import os
+import threading
+import time
+
+# STOCKANALYZER_METRICS=0 turns every span, counter and histogram into a no-op
+ENABLED = os.getenv('STOCKANALYZER_METRICS', '1') != '0'
+# STOCKANALYZER_PROFILING=1 lets a request with the "X-Profile: 1" header dump a cProfile file into PROFILE_DIR
+PROFILING = os.getenv('STOCKANALYZER_PROFILING', '0') == '1'
+PROFILE_DIR = os.getenv('STOCKANALYZER_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  'profiles'))
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)   # seconds
+
+_lock = threading.Lock()
+_counters = {}     # (name, labels) -> value
+_histograms = {}   # (name, labels) -> [bucket counts..., sum, count]
+_gauges = {}       # name -> function returning {labels: value}, evaluated at scrape time
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """add to a counter"""
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """record one value (usually seconds) in a histogram"""
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+        for position, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[position] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def gauge(name, collect):
+    """register collect() -> {labels dict as tuple of pairs: value}, called whenever /metrics is scraped"""
+    _gauges[name] = collect
+
+
+def cache_result(cache, hit):
+    """count a hit or miss for one of the caches"""
+    inc('stockanalyzer_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+class _Span:
+    __slots__ = ('labels', 'start')
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe('stockanalyzer_span_seconds', time.perf_counter() - self.start, **self.labels)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **labels):
+    """context manager timing a block into the stockanalyzer_span_seconds histogram"""
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(dict(labels, span=name))
+
+
+def timed(name):
+    """decorator version of span, returns the function untouched when metrics are disabled"""
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span({'span': name}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (f'{key}="{_escape(value)}"' for key, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus():
+    """all metrics in the prometheus text exposition format"""
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, values):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+
+    for name, collect in sorted(_gauges.items()):
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in sorted(collect().items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_app(app):
+    """per route latency histograms, the /metrics endpoint and optional per request cProfile dumps"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        if PROFILING and request.headers.get('X-Profile') == '1':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_request(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{os.getpid()}.prof"
+            profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+            response.headers['X-Profile-Dump'] = filename
+        start = g.pop('request_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            observe('stockanalyzer_request_seconds', time.perf_counter() - start,
+                    route=route, method=request.method, status=response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """prometheus scrape endpoint"""
+        return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
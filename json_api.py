@@ -0,0 +1,232 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from instrumentation import cache_result
+
+# chart data as compact json for the browser to draw, instead of shipping 300 dpi PNGs.
+# numpy, pandas and the data layer are imported inside the views so registering the blueprint stays cheap
+api = Blueprint('api', __name__, url_prefix='/api')
+
+MAX_POINTS = 5000   # cap on ?points=, the browser can't show more than its canvas width anyway
+DEFAULT_POINTS = 800
+MAX_TICKERS = 20   # per request, every ticker missing from the cache costs a call from the daily API quota
+GZIP_MIN_BYTES = 1024   # smaller bodies aren't worth compressing
+BODY_CACHE_SIZE = 256
+
+_bodies = OrderedDict()   # etag -> (json bytes, gzipped bytes), so repeat requests skip the work entirely
+_bodies_lock = threading.Lock()
+
+
+def _ticker(value):
+    import stock_cache
+    ticker = value.upper()
+    if not stock_cache.is_valid_ticker(ticker):
+        abort(400, description=f"invalid ticker {value!r}")
+    return ticker
+
+
+def _tickers():
+    """?tickers=JPM,GS (up to MAX_TICKERS, duplicates dropped) or the app's INTERESTED_STOCKS"""
+    raw = request.args.get('tickers')
+    if not raw:
+        return list(current_app.config['INTERESTED_STOCKS'])
+    tickers = list(dict.fromkeys(_ticker(ticker.strip()) for ticker in raw.split(',') if ticker.strip()))
+    if len(tickers) > MAX_TICKERS:
+        abort(400, description=f"give at most {MAX_TICKERS} tickers")
+    return tickers
+
+
+def _points():
+    try:
+        points = int(request.args.get('points', DEFAULT_POINTS))
+    except ValueError:
+        abort(400, description="points must be an integer")
+    if points <= 0:
+        return 0   # every row
+    return max(2, min(points, MAX_POINTS))   # minmax keeps a bucket's min and max, so 2 rows is the least it returns
+
+
+def _method(default):
+    method = request.args.get('method', default)
+    if method not in ('lttb', 'minmax'):
+        abort(400, description="method must be lttb or minmax")
+    return method
+
+
+def _version_tag(*parts):
+    """etag built from the request and the last cached bar of each ticker, known before loading any data"""
+    digest = hashlib.sha1(request.full_path.encode())
+    for part in parts:
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def _last_bars(tickers):
+    import stock_cache
+    versions = []
+    for ticker in tickers:
+        meta = stock_cache.read_meta(ticker)
+        if meta is None or stock_cache.is_stale(ticker):
+            return None   # unknown until the data is (re)fetched, so no shortcut
+        versions.append(meta['last_bar'])
+    return versions
+
+
+def _clean(values, decimals=None):
+    """list of floats with NaN turned into null, optionally rounded to keep the payload small"""
+    import numpy as np
+    values = np.asarray(values, dtype=np.float64)
+    if decimals is not None:
+        values = np.round(values, decimals)
+    return [None if value != value else value for value in values.tolist()]
+
+
+def _dates(index):
+    return index.strftime('%Y-%m-%d').tolist()
+
+
+def _respond(etag, build):
+    """serve build() as json with an ETag, answering 304 to a matching If-None-Match and gzipping when accepted"""
+    if etag is not None and etag in request.if_none_match:
+        cache_result('json', hit=True)
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    with _bodies_lock:
+        cached = _bodies.get(etag) if etag is not None else None
+        if cached is not None:
+            _bodies.move_to_end(etag)
+    cache_result('json', hit=cached is not None)
+    if cached is None:
+        payload = build()
+        body = json.dumps(payload, separators=(',', ':'), allow_nan=False).encode()
+        if etag is None:   # data had to be fetched first, tag the actual content
+            etag = hashlib.sha1(body).hexdigest()
+        cached = (body, gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None)
+        with _bodies_lock:
+            _bodies[etag] = cached
+            while len(_bodies) > BODY_CACHE_SIZE:
+                _bodies.popitem(last=False)
+
+    body, gzipped = cached
+    response = Response(body, mimetype='application/json')
+    if gzipped is not None and 'gzip' in request.accept_encodings:
+        response.set_data(gzipped)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.cache_control.no_cache = True   # always revalidate, the 304 is cheap
+    return response.make_conditional(request)
+
+
+def _stock_df(ticker, prepped=False):
+    from data import get_stock_df, get_prepped_stock_df
+    df = get_prepped_stock_df(ticker) if prepped else get_stock_df(ticker)
+    if df is None or not len(df):
+        abort(404, description=f"no data for {ticker}")
+    return df
+
+
+def _windows():
+    """?windows=20,50,ema20 as parsed by moving_averages.parse_windows, the 20 day average by default"""
+    from moving_averages import parse_windows
+    try:
+        return parse_windows(request.args.get('windows', '20'))
+    except ValueError as error:
+        abort(400, description=str(error))
+
+
+@api.route("/movingavg/<ticker>")
+def moving_average(ticker):
+    """close and the ?windows= moving averages (20 day by default), downsampled to ?points= (lttb by default)"""
+    from downsample import downsample
+    from moving_averages import column_name, moving_averages
+    ticker, points, method, windows = _ticker(ticker), _points(), _method('lttb'), _windows()
+    last_bars = _last_bars([ticker])
+    etag = _version_tag(last_bars) if last_bars else None
+
+    def build():
+        df = moving_averages(ticker, _stock_df(ticker), windows)
+        names = [column_name(kind, window) for kind, window in windows]
+        df = df[df[names].notna().any(axis=1)]   # start once the shortest window is complete
+        keep = downsample(df['close'].to_numpy(), points, method)
+        rows = df.iloc[keep]
+        payload = {'ticker': ticker, 'dates': _dates(rows.index), 'close': _clean(rows['close'], 4)}
+        payload.update({name: _clean(rows[name], 4) for name in names})
+        return payload
+    return _respond(etag, build)
+
+
+@api.route("/returns/<ticker>")
+def returns(ticker):
+    """daily returns, downsampled to ?points= (minmax by default so every spike survives)"""
+    from downsample import downsample
+    ticker, points, method = _ticker(ticker), _points(), _method('minmax')
+    last_bars = _last_bars([ticker])
+    etag = _version_tag(last_bars) if last_bars else None
+
+    def build():
+        df = _stock_df(ticker, prepped=True)
+        keep = downsample(df['daily returns'].to_numpy(), points, method)
+        rows = df.iloc[keep]
+        return {'ticker': ticker, 'dates': _dates(rows.index), 'daily returns': _clean(rows['daily returns'], 6)}
+    return _respond(etag, build)
+
+
+def _panel(tickers):
+    from analysis import returns_panel
+    frames = {ticker: _stock_df(ticker) for ticker in tickers}
+    return returns_panel(frames)
+
+
+@api.route("/correlation")
+def correlation():
+    """correlation matrix of daily returns for ?tickers="""
+    tickers = _tickers()
+    last_bars = _last_bars(tickers)
+    etag = _version_tag(last_bars) if last_bars else None
+
+    def build():
+        from analysis import calc_correlation
+        matrix = calc_correlation(_panel(tickers))   # in the offload pool for large panels
+        return {'tickers': tickers, 'matrix': [_clean(row, 4) for row in matrix.to_numpy()]}
+    return _respond(etag, build)
+
+
+@api.route("/stdev")
+def stdev():
+    """standard deviation of daily returns for ?tickers="""
+    tickers = _tickers()
+    last_bars = _last_bars(tickers)
+    etag = _version_tag(last_bars) if last_bars else None
+
+    def build():
+        return {'tickers': tickers, 'stdev': _clean(_panel(tickers).stdev(), 6)}
+    return _respond(etag, build)
+
+
+@api.route("/linreg/<ticker>")
+def linear_regression(ticker):
+    """20 day moving average vs daily returns scatter (evenly thinned to ?points=) plus the fitted model"""
+    import numpy as np
+    from downsample import stride
+    from model_registry import get_model
+    ticker, points = _ticker(ticker), _points()
+    last_bars = _last_bars([ticker])
+    etag = _version_tag(last_bars) if last_bars else None
+
+    def build():
+        df = _stock_df(ticker, prepped=True)
+        entry = get_model(ticker, df, background=False, prepped=True, plot=False)   # never older than the data,
+        # and no png since the browser draws the scatter itself
+        keep = stride(len(df), points) if points else np.arange(len(df))
+        rows = df.iloc[keep]
+        return {'ticker': ticker, 'version': entry.version, 'score': entry.score,
+                'predicted_return': entry.predicted_return,
+                'intercept': float(entry.model.intercept_), 'coef': _clean(entry.model.coef_),
+                'x': _clean(rows['20 day moving average'], 4), 'y': _clean(rows['daily returns'], 6)}
+    return _respond(etag, build)
@@ -0,0 +1,105 @@
+import threading
+from collections import namedtuple
+
+import pandas as pd
+
+from analysis import make_plot, train_linreg_model, predict_returns, prep_data_for_model
+from instrumentation import cache_result
+from render_cache import touch
+
+# everything the /linreg page needs, computed once per ticker and per last bar of training data
+ModelEntry = namedtuple('ModelEntry', ['ticker', 'version', 'model', 'score', 'predicted_return',
+                                       'latest_date', 'latest_close', 'latest_ma', 'plot_path'])
+
+_entries = {}   # ticker -> newest ModelEntry
+_inflight = {}  # (ticker, version) -> lock held by the one thread doing the training
+_guard = threading.Lock()
+
+
+def _version(df):
+    """models are versioned by the date of the last bar they were trained on"""
+    return df.index[-1].strftime('%Y-%m-%d')
+
+
+def _train(ticker, df, prepped):
+    """fit the model, score it and predict the next return, the plot is rendered separately by _with_plot"""
+    prepped_df = df if prepped else prep_data_for_model(df)
+    model, score = train_linreg_model(prepped_df, prepped=True)
+    latest_data = prepped_df.iloc[-1]   # getting last row which is the most recent line
+    x_vars = pd.DataFrame({   # getting hold of just the most recent data for interested columns
+        '20 day moving average': [latest_data['20 day moving average']],
+        'close': [latest_data['close']]
+    })
+    predicted_return = predict_returns(model, x_vars)[0]   # model returns a numpy array, so take the single value
+    return ModelEntry(ticker=ticker, version=_version(df), model=model, score=round(score, 4),
+                      predicted_return=round(predicted_return, 4),
+                      latest_date=prepped_df.index[-1].strftime('%Y-%m-%d'),
+                      latest_close=latest_data['close'], latest_ma=latest_data['20 day moving average'],
+                      plot_path=None)
+
+
+def _with_plot(entry, df, prepped):
+    """entry with its regression plot rendered, df is the data the entry was trained on"""
+    if entry.plot_path is not None and touch(entry.plot_path):   # else it was evicted, render it again
+        return entry
+    prepped_df = df if prepped else prep_data_for_model(df)
+    plot_path = make_plot(columnx='20 day moving average', columny='daily returns',
+                          prepped_data=prepped_df, title=f"{entry.ticker} Linear Regression")
+    entry = entry._replace(plot_path=plot_path)
+    with _guard:
+        current = _entries.get(entry.ticker)
+        if current is not None and current.version == entry.version:
+            _entries[entry.ticker] = entry
+    return entry
+
+
+def _train_once(ticker, df, prepped, plot=True):
+    """single-flight training, concurrent callers for the same version wait for one fit instead of starting their own"""
+    version = _version(df)
+    key = (ticker, version)
+    with _guard:
+        lock = _inflight.setdefault(key, threading.Lock())
+    with lock:
+        try:
+            entry = _entries.get(ticker)
+            if entry is None or entry.version != version:   # else another thread finished it while we waited
+                entry = _train(ticker, df, prepped)
+                with _guard:
+                    _entries[ticker] = entry
+        except Exception as error:   # the next get_model for this version tries again
+            print(f"Training the {ticker} model on data up to {version} failed: {type(error).__name__}: {error}")
+            raise
+        finally:
+            with _guard:
+                _inflight.pop(key, None)
+    return _with_plot(entry, df, prepped) if plot else entry
+
+
+def get_model(ticker, df, background=True, prepped=False, plot=True):
+    """
+    return the cached ModelEntry for ticker, training it if df has a newer last bar.
+    pass prepped=True if df already went through prep_data_for_model (or data.get_prepped_stock_df).
+    with background=True a stale entry is served right away while the new version trains on a thread,
+    the very first request for a ticker always trains inline since there is nothing to serve yet.
+    plot=False skips rendering the regression plot (plot_path may then be None), for callers that only need numbers
+    """
+    version = _version(df)
+    with _guard:
+        entry = _entries.get(ticker)
+        hit = entry is not None and entry.version == version
+        already_training = (ticker, version) in _inflight
+    cache_result('model', hit=hit)
+    if hit:
+        return _with_plot(entry, df, prepped) if plot else entry
+
+    if entry is not None and background and (not plot or entry.plot_path is not None and touch(entry.plot_path)):
+        if not already_training:
+            threading.Thread(target=_train_once, args=(ticker, df, prepped, plot), daemon=True).start()
+        return entry
+    return _train_once(ticker, df, prepped, plot)
+
+
+def clear():
+    """forget every cached model"""
+    with _guard:
+        _entries.clear()
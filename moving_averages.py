@@ -0,0 +1,101 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import cache_result, timed
+
+# simple and exponential moving averages for any set of windows, written like "20,50,200,ema20"
+DEFAULT_WINDOWS = 'sma20,sma50,sma200,ema20'
+MAX_WINDOW = 2000   # about 8 years of bars
+MAX_WINDOWS = 8
+CACHE_SIZE = 128   # (ticker, windows, last bar) entries
+
+_WINDOW_PATTERN = re.compile(r'^(sma|ema)?(\d+)$')
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def parse_windows(text):
+    """
+    ('sma', 20), ('ema', 50), ... from "20,50,ema50" (a bare number is a simple moving average). raises ValueError
+    for anything else, duplicates are dropped and the order is kept
+    """
+    windows = []
+    for part in (text or '').lower().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = _WINDOW_PATTERN.match(part)
+        if match is None or not 2 <= int(match.group(2)) <= MAX_WINDOW:
+            raise ValueError(f"window {part!r} must look like 20, sma50 or ema200 (2 to {MAX_WINDOW} days)")
+        window = (match.group(1) or 'sma', int(match.group(2)))
+        if window not in windows:
+            windows.append(window)
+    if not windows or len(windows) > MAX_WINDOWS:
+        raise ValueError(f"give between 1 and {MAX_WINDOWS} windows")
+    return tuple(windows)
+
+
+def column_name(kind, window):
+    """'20 day moving average' (the name prep_data_for_model uses) or '20 day EMA'"""
+    return f"{window} day moving average" if kind == 'sma' else f"{window} day EMA"
+
+
+def compute(close, windows):
+    """
+    {column name: array} for every window over a 1d array of closes. all simple averages come from one shared
+    cumulative sum (each window is then a single vectorized subtraction, O(rows) however long the window),
+    exponential ones from pandas' ewm with span=window. the first window-1 values are NaN, as with rolling()
+    """
+    close = np.asarray(close, dtype=np.float64)
+    rows = len(close)
+    results = {}
+    sma_windows = [window for kind, window in windows if kind == 'sma']
+    if sma_windows:
+        valid = ~np.isnan(close)
+        shift = close[valid].mean() if valid.any() else 0.0   # centering keeps the running sum well conditioned
+        sums = np.zeros(rows + 1)
+        np.cumsum(np.where(valid, close - shift, 0.0), out=sums[1:])
+        counts = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(valid, out=counts[1:])
+        for window in sma_windows:
+            average = np.full(rows, np.nan)
+            if rows >= window:
+                window_sums = sums[window:] - sums[:-window]
+                full = counts[window:] - counts[:-window] == window   # a missing close blanks the window, like pandas
+                average[window - 1:] = np.where(full, window_sums / window + shift, np.nan)
+            results[column_name('sma', window)] = average
+    for kind, window in windows:
+        if kind == 'ema':
+            ema = pd.Series(close).ewm(span=window, adjust=False, min_periods=window).mean().to_numpy()
+            results[column_name('ema', window)] = ema
+    return {column_name(kind, window): results[column_name(kind, window)] for kind, window in windows}
+
+
+def add_moving_averages(df, windows):
+    """copy of df (needs a 'close' column) with a column per window"""
+    return df.assign(**compute(df['close'].to_numpy(), windows))
+
+
+@timed('moving_averages')
+def moving_averages(ticker, df, windows):
+    """
+    add_moving_averages for a ticker's bars, cached per ticker, window set and last bar so repeat requests and
+    pages sharing a ticker only compute it once per new bar
+    """
+    key = (ticker, windows, len(df), df.index[-1] if len(df) else None)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+    cache_result('moving_averages', hit=cached is not None)
+    if cached is None:
+        cached = add_moving_averages(df, windows)
+        with _cache_lock:
+            _cache[key] = cached
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return cached
@@ -0,0 +1,309 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from instrumentation import gauge, inc, span
+
+# CPU heavy analysis (model fitting, large correlation matrices, every matplotlib render) runs in a small process
+# pool instead of the request thread, so it doesn't hold the GIL while other requests on the same worker wait.
+# Arrays, dataframes and series go to and from the pool through one shared memory block per call instead of being
+# pickled, identical jobs already in flight are shared, and a full queue is refused (Busy, a 503) instead of growing.
+# With STOCKANALYZER_OFFLOAD=0 (the default) everything runs inline exactly as before
+ENABLED = os.getenv('STOCKANALYZER_OFFLOAD', '0') == '1'
+WORKERS = int(os.getenv('OFFLOAD_WORKERS', str(min(max((os.cpu_count() or 2) - 1, 1), 4))))   # a core left for flask
+MAX_PENDING = int(os.getenv('OFFLOAD_MAX_PENDING', str(WORKERS * 4)))   # distinct jobs queued or running
+TIMEOUT = float(os.getenv('OFFLOAD_TIMEOUT', '30'))   # seconds a caller waits for its result
+RESULT_TTL = float(os.getenv('OFFLOAD_RESULT_TTL', '60'))   # seconds a finished job's result is kept for a retry,
+# longer than the Retry-After a timed out caller is given
+ALIGNMENT = 64   # byte alignment of every array in a block
+
+SharedArray = namedtuple('SharedArray', ['offset', 'dtype', 'shape'])
+SharedIndex = namedtuple('SharedIndex', ['values', 'name'])
+SharedFrame = namedtuple('SharedFrame', ['columns', 'values', 'index'])   # values: SharedArray or object column
+SharedSeries = namedtuple('SharedSeries', ['values', 'index', 'name'])
+
+
+class Busy(RuntimeError):
+    """MAX_PENDING distinct jobs are already queued or running, try again later"""
+
+
+class Timeout(TimeoutError):
+    """a job didn't finish within its timeout, it keeps running and a retry (within RESULT_TTL of it finishing) gets
+    its result"""
+
+
+_pool = None
+_inflight = {}   # job key -> Future shared by every caller of that job
+_finished = {}   # job key -> (expiry, Future) of jobs that returned something in the last RESULT_TTL seconds
+_lock = threading.Lock()
+_in_worker = False   # set in pool processes, where run() calls straight through
+gauge('stockanalyzer_offload_pending', lambda: {(): len(_inflight)})
+
+
+class _Packer:
+    """swaps every array in a value (dataframes and series column by column) for its place in one block"""
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def array(self, values):
+        import numpy as np
+        values = np.ascontiguousarray(values)
+        if values.dtype.hasobject:   # strings and mixed objects are pickled as usual
+            return values
+        shared = SharedArray(self.size, values.dtype.str, values.shape)
+        self.arrays.append((shared, values))
+        self.size += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+        return shared
+
+    def index(self, index):
+        values = index.to_numpy()
+        if values.dtype.hasobject:   # ticker labels and the like are small
+            return index
+        return SharedIndex(self.array(values), index.name)
+
+    def pack(self, value):
+        import numpy as np
+        import pandas as pd
+        if isinstance(value, pd.DataFrame) and value.columns.is_unique:
+            return SharedFrame(value.columns, [self.array(value[column].to_numpy()) for column in value.columns],
+                               self.index(value.index))
+        if isinstance(value, pd.Series):
+            return SharedSeries(self.array(value.to_numpy()), self.index(value.index), value.name)
+        if isinstance(value, np.ndarray):
+            return self.array(value)
+        if isinstance(value, dict):
+            return {key: self.pack(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+            return type(value)(self.pack(item) for item in value)
+        return value
+
+    def write(self):
+        """copy the arrays into a new shared memory block, returns the block (None if there were no arrays)"""
+        from multiprocessing import shared_memory
+        import numpy as np
+        if not self.size:
+            return None
+        block = shared_memory.SharedMemory(create=True, size=self.size)
+        for shared, values in self.arrays:
+            np.ndarray(shared.shape, shared.dtype, buffer=block.buf, offset=shared.offset)[...] = values
+        return block
+
+
+def _unpack(value, buffer, copy):
+    """rebuild what _Packer.pack replaced, as views into buffer or (copy=True) arrays of their own"""
+    import numpy as np
+    import pandas as pd
+    if isinstance(value, SharedArray):
+        array = np.ndarray(value.shape, value.dtype, buffer=buffer, offset=value.offset)
+        return array.copy() if copy else array
+    if isinstance(value, SharedIndex):
+        return pd.Index(_unpack(value.values, buffer, copy), name=value.name)
+    if isinstance(value, SharedFrame):
+        columns = {position: _unpack(values, buffer, copy) for position, values in enumerate(value.values)}
+        frame = pd.DataFrame(columns, index=_unpack(value.index, buffer, copy), copy=False)
+        frame.columns = value.columns
+        return frame
+    if isinstance(value, SharedSeries):
+        return pd.Series(_unpack(value.values, buffer, copy), index=_unpack(value.index, buffer, copy),
+                         name=value.name, copy=False)
+    if isinstance(value, dict):
+        return {key: _unpack(item, buffer, copy) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+        return type(value)(_unpack(item, buffer, copy) for item in value)
+    return value
+
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:   # a view into it is still referenced somewhere, the mapping goes away with that view
+        pass
+
+
+def _init_worker():
+    """pool process start up, loads the analysis stack once instead of on the first job"""
+    global _in_worker
+    _in_worker = True
+    import analysis
+    analysis._plotting()
+    import sklearn.linear_model  # noqa: F401
+
+
+def _execute(func, block_name, args, kwargs):
+    """runs in a pool process: attach the arguments' block, call func, hand the result back in a block of its own"""
+    from multiprocessing import shared_memory
+    block = shared_memory.SharedMemory(name=block_name) if block_name else None
+    try:
+        buffer = block.buf if block else None
+        result = func(*_unpack(args, buffer, False), **_unpack(kwargs, buffer, False))
+        del buffer
+        packer = _Packer()
+        packed = packer.pack(result)
+        result_block = packer.write()
+        if result_block is None:
+            return None, packed
+        _close(result_block)   # the caller unlinks it once it has copied the result out
+        return result_block.name, packed
+    finally:
+        if block:
+            _close(block)
+
+
+def _job_key(func, args, kwargs):
+    """blake2b of the function and the contents of its arguments, jobs with the same key share one run"""
+    import numpy as np
+    import pandas as pd
+    digest = hashlib.blake2b(f"{func.__module__}.{func.__qualname__}".encode(), digest_size=20)
+
+    def feed(value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+            digest.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+        elif isinstance(value, np.ndarray):
+            digest.update(repr((value.dtype.str, value.shape)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes() if not value.dtype.hasobject else repr(value).encode())
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                digest.update(repr(key).encode())
+                feed(item)
+        elif isinstance(value, (list, tuple)):
+            digest.update(f"{type(value).__name__}{len(value)}".encode())
+            for item in value:
+                feed(item)
+        else:
+            digest.update(repr(value).encode())
+        digest.update(b'\0')
+    feed(args)
+    feed(sorted(kwargs.items()))
+    return digest.hexdigest()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # forkserver: forking a process that is running flask's threads can copy a lock held by one of them
+        _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+                                    initializer=_init_worker)
+    return _pool
+
+
+def _finish(key, job, name, block, pool_future):
+    """done callback of the pool future: copy the result out of its block and release both blocks"""
+    from concurrent.futures.process import BrokenProcessPool
+    from multiprocessing import shared_memory
+    global _pool
+    if block:
+        _close(block)
+        block.unlink()
+    try:
+        result_name, packed = pool_future.result()
+        if result_name:
+            result_block = shared_memory.SharedMemory(name=result_name)
+            try:
+                result = _unpack(packed, result_block.buf, True)
+            finally:
+                _close(result_block)
+                result_block.unlink()
+        else:
+            result = _unpack(packed, None, True)
+    except BaseException as error:
+        if isinstance(error, BrokenProcessPool):   # a worker died (e.g. out of memory), start a fresh pool next time
+            with _lock:
+                _pool = None
+        inc('stockanalyzer_offload_jobs_total', func=name, result='failed')
+        job.set_exception(error)
+    else:
+        inc('stockanalyzer_offload_jobs_total', func=name, result='done')
+        job.set_result(result)
+        if result is not None:   # a render returns None, its result is the file, which may get evicted meanwhile
+            with _lock:   # before leaving _inflight, so a retry finds it in one or the other
+                _finished[key] = (time.monotonic() + RESULT_TTL, job)
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+def _expire_finished(now):
+    """drop results past their RESULT_TTL, call with _lock held"""
+    for key in [key for key, (expiry, _) in _finished.items() if expiry <= now]:
+        del _finished[key]
+
+
+def submit(func, *args, key=None, **kwargs):
+    """
+    schedule func(*args, **kwargs) in the pool and return a Future for its result. func must be importable by name
+    (a module level function). key identifies the job (default a hash of func and the arguments' contents), a job
+    with the same key already queued, running or finished within RESULT_TTL is shared instead of started again.
+    raises Busy when MAX_PENDING distinct jobs are already pending
+    """
+    global _pool
+    name = func.__name__
+    key = key or _job_key(func, args, kwargs)
+    with _lock:
+        job = _inflight.get(key)
+        if job is not None:
+            inc('stockanalyzer_offload_jobs_total', func=name, result='shared')
+            return job
+        _expire_finished(time.monotonic())
+        if key in _finished:   # e.g. the retry of a caller that timed out
+            inc('stockanalyzer_offload_jobs_total', func=name, result='finished')
+            return _finished[key][1]
+        if len(_inflight) >= MAX_PENDING:
+            inc('stockanalyzer_offload_jobs_total', func=name, result='rejected')
+            raise Busy(f"{len(_inflight)} jobs pending, not starting {name}")
+        job = _inflight[key] = Future()
+        pool = _get_pool()   # imports multiprocessing, kept out of flask_app's import
+
+    block = None
+    try:
+        packer = _Packer()
+        packed_args, packed_kwargs = packer.pack(args), packer.pack(kwargs)
+        block = packer.write()
+        pool_future = pool.submit(_execute, func, block.name if block else None, packed_args, packed_kwargs)
+    except BaseException as error:
+        from concurrent.futures.process import BrokenProcessPool
+        if block:
+            _close(block)
+            block.unlink()
+        with _lock:
+            _inflight.pop(key, None)
+            if isinstance(error, BrokenProcessPool):
+                _pool = None
+        job.set_exception(error)
+        raise
+    pool_future.add_done_callback(lambda done: _finish(key, job, name, block, done))
+    return job
+
+
+def run(func, *args, key=None, timeout=None, **kwargs):
+    """
+    func(*args, **kwargs) in the pool, blocking until it's done. Inline when offloading is disabled or when already
+    running in a pool process. raises Busy when the queue is full and Timeout after timeout (default TIMEOUT) seconds,
+    the job itself isn't cancelled, so a retry of the same job picks up its result (see RESULT_TTL)
+    """
+    if not ENABLED or _in_worker:
+        return func(*args, **kwargs)
+    timeout = TIMEOUT if timeout is None else timeout
+    job = submit(func, *args, key=key, **kwargs)
+    with span('offload', func=func.__name__):
+        try:
+            return job.result(timeout)
+        except FutureTimeout:
+            inc('stockanalyzer_offload_jobs_total', func=func.__name__, result='timeout')
+            raise Timeout(f"{func.__name__} still running after {timeout}s") from None
+
+
+def shutdown(wait=True):
+    """stop the pool processes, a later job starts a new pool"""
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+        _finished.clear()
+    if pool is not None:
+        pool.shutdown(wait=wait)
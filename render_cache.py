@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+import time
+
+from instrumentation import cache_result, span
+
+# rendered plots are named after a hash of their input data and plot parameters, so the same
+# inputs always map to the same file and different requests can never overwrite each other's image
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+RENDER_SUBDIR = 'renders'
+RENDER_DIR = os.path.join(STATIC_DIR, RENDER_SUBDIR)
+MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))   # evict oldest renders past this
+STALE_TMP_SECONDS = 10 * 60   # a half written render this old belongs to a draw that died
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def render_key(kind, data, params):
+    """sha256 over the plot kind, its parameters and the contents (values, index and columns) of the data"""
+    import pandas as pd   # only needed once there is something to render, keeps flask_app's import light
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    digest.update(repr(sorted(params.items())).encode())
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+        names = data.columns if isinstance(data, pd.DataFrame) else [data.name]
+        digest.update(repr(list(names)).encode())
+    else:
+        digest.update(repr(data).encode())
+    return digest.hexdigest()
+
+
+def evict(max_bytes=MAX_BYTES):
+    """delete least recently used renders until the folder fits in max_bytes, and tmp files left by dead draws"""
+    try:
+        scanned = [entry for entry in os.scandir(RENDER_DIR) if entry.name.endswith('.png')]
+    except FileNotFoundError:
+        return
+    entries = []
+    stale_before = time.time() - STALE_TMP_SECONDS
+    for entry in scanned:
+        if not entry.name.endswith('.tmp.png'):
+            entries.append(entry)
+            continue
+        try:
+            if entry.stat().st_mtime < stale_before:
+                os.remove(entry.path)
+        except FileNotFoundError:   # moved into place or removed meanwhile
+            pass
+    entries.sort(key=lambda entry: entry.stat().st_atime)   # hits and touch() bump the atime, so it's last use
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        try:
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+        except FileNotFoundError:   # another worker already evicted it
+            pass
+
+
+def touch(relative_path):
+    """
+    mark a render served from a saved path (instead of through cached_render) as recently used for LRU eviction,
+    False if it was evicted already
+    """
+    img_path = os.path.join(RENDER_DIR, os.path.basename(relative_path))
+    try:   # mtime is left alone because flask builds the ETag from it
+        os.utime(img_path, (time.time(), os.stat(img_path).st_mtime))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def save_atomically(img_path, draw, *args):
+    """
+    draw(tmp_path, *args) next to img_path, then move it into place in one step so the file is never served half
+    written. runs wherever the drawing does (e.g. in an offload pool process), so a draw whose caller stopped waiting
+    still ends up in the cache
+    """
+    tmp_path = f"{img_path}.{os.getpid()}.{threading.get_ident()}.tmp.png"
+    try:
+        draw(tmp_path, *args)
+        os.replace(tmp_path, img_path)
+    finally:
+        if os.path.exists(tmp_path):   # draw failed part way
+            os.remove(tmp_path)
+
+
+def cached_render(kind, data, params, draw):
+    """
+    return the path (relative to static/) of the png for these inputs, only calling draw(img_path)
+    to run matplotlib when no render with the same content hash exists yet. draw has to create img_path atomically,
+    e.g. through save_atomically
+    """
+    filename = f"{kind}-{render_key(kind, data, params)[:24]}.png"
+    img_path = os.path.join(RENDER_DIR, filename)
+    relative_path = f"{RENDER_SUBDIR}/{filename}"
+
+    with _locks_guard:
+        lock = _locks.setdefault(filename, threading.Lock())
+    try:
+        with lock:   # two requests for the same new plot only render it once
+            if touch(relative_path):
+                cache_result('render', hit=True)
+                return relative_path
+            cache_result('render', hit=False)
+            os.makedirs(RENDER_DIR, exist_ok=True)
+            with span('render', kind=kind):
+                draw(img_path)
+    finally:
+        with _locks_guard:
+            _locks.pop(filename, None)
+    evict()
+    print(f"Plot saved to {img_path}")
+    return relative_path
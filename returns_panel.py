@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+
+def _returns_from_close(close):
+    """
+    daily returns for every column of a (dates x tickers) close matrix, each return uses the ticker's previous
+    available close, which matches running pct_change() on each ticker's own dataframe
+    """
+    returns = np.full(close.shape, np.nan)
+    valid = ~np.isnan(close)
+    if valid.all():   # no gaps, so the previous close is simply the row above
+        np.divide(close[1:], close[:-1], out=returns[1:])
+        returns[1:] -= 1
+        return returns
+    rows = np.arange(close.shape[0])[:, None]
+    last_valid = np.where(valid, rows, -1)
+    np.maximum.accumulate(last_valid, axis=0, out=last_valid)   # row of the latest close at or before each row
+    filled = np.take_along_axis(close, np.maximum(last_valid, 0), axis=0)   # forward filled closes
+    returns[1:] = close[1:] / filled[:-1] - 1   # NaN wherever today's close is missing
+    returns[1:][last_valid[:-1] < 0] = np.nan   # no earlier close to compare against
+    return returns
+
+
+def _window_sums(values, window):
+    """sum of every trailing window along axis 0 in O(1) per row using a cumulative sum, first window-1 rows NaN"""
+    cumulative = np.cumsum(values, axis=0)
+    sums = np.full(values.shape, np.nan)
+    sums[window - 1] = cumulative[window - 1]
+    sums[window:] = cumulative[window:] - cumulative[:-window]
+    return sums
+
+
+class ReturnsPanel:
+    """
+    close prices and daily returns for many tickers aligned once on a shared date index, held as contiguous
+    (dates x tickers) float64 arrays. Correlation, covariance, stdev and rolling stats are all computed from
+    this one panel, so a page showing several statistics only does the alignment and returns once.
+    Missing bars are NaN and statistics use pairwise complete observations, same as pandas.
+    """
+    def __init__(self, tickers, dates, close):
+        self.tickers = list(tickers)
+        self.dates = dates
+        self.close = np.ascontiguousarray(close, dtype=np.float64)
+        self.returns = _returns_from_close(self.close)
+
+    @classmethod
+    def from_frames(cls, dataframe_dict):
+        """align the 'close' column of {ticker: dataframe} on the union of their dates, inputs aren't modified"""
+        tickers = list(dataframe_dict)
+        indexes = [pd.DatetimeIndex(dataframe_dict[ticker].index).values for ticker in tickers]
+        closes = [dataframe_dict[ticker]['close'].to_numpy(dtype=np.float64) for ticker in tickers]
+        if indexes and all(np.array_equal(index, indexes[0]) for index in indexes) \
+                and (np.diff(indexes[0]) > np.timedelta64(0)).all():
+            dates = indexes[0]   # already share one sorted calendar, skip the union
+            return cls(tickers, pd.DatetimeIndex(dates), np.column_stack(closes))
+        distinct = {index.tobytes(): index for index in indexes}   # most tickers share a calendar, union those once
+        dates = np.unique(np.concatenate(list(distinct.values()))) if indexes else np.array([], dtype='datetime64[ns]')
+        positions = {key: np.searchsorted(dates, index) for key, index in distinct.items()}
+        close = np.full((len(dates), len(tickers)), np.nan)
+        for column, (index, values) in enumerate(zip(indexes, closes)):
+            close[positions[index.tobytes()], column] = values
+        return cls(tickers, pd.DatetimeIndex(dates), close)
+
+    def _pairwise_sums(self):
+        """count, sums and cross products over rows where both tickers of each pair have a return"""
+        x = self.returns
+        valid = ~np.isnan(x)
+        if valid[1:].all():   # fully aligned panel (first row is always NaN), plain matrix products
+            x = x[1:]
+            n = np.full((x.shape[1], x.shape[1]), float(x.shape[0]))
+            column_sums = x.sum(axis=0)
+            sx = np.broadcast_to(column_sums[:, None], n.shape)
+            sxx = np.broadcast_to((x * x).sum(axis=0)[:, None], n.shape)
+            return n, sx, sxx, x.T @ x
+        mask = valid.astype(np.float64)
+        x0 = np.where(valid, x, 0.0)
+        # entry [i, j] of each product only sums rows where both ticker i and ticker j are present
+        return mask.T @ mask, x0.T @ mask, (x0 * x0).T @ mask, x0.T @ x0
+
+    def covariance(self):
+        """covariance matrix of daily returns (ddof=1)"""
+        n, sx, sxx, sxy = self._pairwise_sums()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = (sxy - sx * sx.T / n) / (n - 1)
+        cov[n < 2] = np.nan
+        return pd.DataFrame(cov, index=self.tickers, columns=self.tickers)
+
+    def correlation(self):
+        """pearson correlation matrix of daily returns"""
+        n, sx, sxx, sxy = self._pairwise_sums()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centered_xy = sxy - sx * sx.T / n
+            centered_xx = sxx - sx * sx / n   # variance of ticker i over the rows shared with ticker j
+            corr = centered_xy / np.sqrt(centered_xx * centered_xx.T)
+        corr[n < 2] = np.nan
+        np.clip(corr, -1, 1, out=corr)
+        np.fill_diagonal(corr, np.where(np.diag(n) >= 2, 1.0, np.nan))
+        return pd.DataFrame(corr, index=self.tickers, columns=self.tickers)
+
+    def stdev(self):
+        """standard deviation of daily returns per ticker (ddof=1)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stdev = np.nanstd(self.returns, axis=0, ddof=1)
+        return pd.Series(stdev, index=self.tickers)
+
+    def rolling_volatility(self, window):
+        """trailing window stdev of returns for every ticker, windows with a missing return are NaN"""
+        x = self.returns
+        valid = ~np.isnan(x)
+        shift = np.nanmean(x, axis=0) if valid.any() else 0.0   # centering keeps the running sums well conditioned
+        x0 = np.where(valid, x - shift, 0.0)
+        count = _window_sums(valid.astype(np.float64), window)
+        s1 = _window_sums(x0, window)
+        s2 = _window_sums(x0 * x0, window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (s2 - s1 * s1 / window) / (window - 1)
+        var[count < window] = np.nan
+        return pd.DataFrame(np.sqrt(np.maximum(var, 0)), index=self.dates, columns=self.tickers)
+
+    def rolling_correlation(self, ticker, window):
+        """trailing window correlation of every ticker's returns with `ticker`'s returns"""
+        x = self.returns
+        y = x[:, [self.tickers.index(ticker)]]
+        valid = ~np.isnan(x) & ~np.isnan(y)
+        x0 = np.where(valid, x - np.nanmean(x, axis=0), 0.0)
+        y0 = np.where(valid, y - np.nanmean(y), 0.0)
+        count = _window_sums(valid.astype(np.float64), window)
+        sx, sy = _window_sums(x0, window), _window_sums(y0, window)
+        sxy, sxx, syy = _window_sums(x0 * y0, window), _window_sums(x0 * x0, window), _window_sums(y0 * y0, window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = (sxy - sx * sy / window) / np.sqrt((sxx - sx * sx / window) * (syy - sy * sy / window))
+        corr[count < window] = np.nan
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.dates, columns=self.tickers)
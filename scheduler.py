@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from instrumentation import inc, span
+
+# end of day refresh of everything the pages serve, as a DAG:
+#   raw:<ticker> -> indicators:<ticker> -> model:<ticker>        (linreg model, score and prediction)
+#   raw:<ticker> -> chart:movingavg:<ticker>                      (moving average cache behind the charts)
+# the pages draw their charts in the browser from /api, so there are no plots to render here
+# raw nodes always run (a cache read when nothing new was published), every other node is only rebuilt when the
+# versions of its inputs changed since its last build
+ENABLED = os.getenv('STOCKANALYZER_SCHEDULER', '0') == '1'
+DELAY_MINUTES = int(os.getenv('SCHEDULER_DELAY_MINUTES', '15'))   # after stock_cache.MARKET_CLOSE
+MAX_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '4'))
+# every gunicorn worker imports flask_app and starts a scheduler, but only the one holding the lock file schedules.
+# it publishes its status to STATE_PATH, so /jobs looks the same from every worker
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCK_PATH = os.getenv('SCHEDULER_LOCK_PATH', os.path.join(_PROJECT_DIR, 'scheduler.lock'))
+STATE_PATH = os.getenv('SCHEDULER_STATE_PATH', os.path.join(_PROJECT_DIR, 'scheduler_state.json'))
+STANDBY_SECONDS = 60   # how often a standby worker checks whether the leader went away
+
+Node = namedtuple('Node', ['name', 'kind', 'deps', 'build'])
+Result = namedtuple('Result', ['version', 'artifact', 'inputs'])   # inputs: versions of the deps it was built from
+
+
+def _raw(ticker):
+    def build(inputs):
+        from data import get_stock_df
+        df = get_stock_df(ticker)   # refreshes from the API (within quota) only if the cache is stale
+        if df is None or not len(df):
+            raise RuntimeError(f"no data for {ticker}")
+        return (len(df), df.index[-1].strftime('%Y-%m-%d')), df
+    return build
+
+
+def _indicators(ticker):
+    def build(inputs):
+        from data import get_prepped_stock_df
+        return None, get_prepped_stock_df(ticker)
+    return build
+
+
+def _model(ticker):
+    def build(inputs):
+        from model_registry import get_model
+        prepped = inputs[f"indicators:{ticker}"]
+        return None, get_model(ticker, prepped, background=False, prepped=True, plot=False)
+    return build
+
+
+def _moving_average_chart(ticker):
+    def build(inputs):
+        from moving_averages import DEFAULT_WINDOWS, moving_averages, parse_windows
+        moving_averages(ticker, inputs[f"raw:{ticker}"], parse_windows(DEFAULT_WINDOWS))
+        return None, None
+    return build
+
+
+def build_graph(tickers, model_tickers=()):
+    """the nodes for tickers (model_tickers get a raw node too), every node comes after its dependencies"""
+    nodes = [Node(f"raw:{ticker}", 'raw', (), _raw(ticker)) for ticker in dict.fromkeys([*tickers, *model_tickers])]
+    nodes += [Node(f"indicators:{ticker}", 'indicators', (f"raw:{ticker}",), _indicators(ticker))
+              for ticker in model_tickers]
+    nodes += [Node(f"model:{ticker}", 'model', (f"indicators:{ticker}",), _model(ticker)) for ticker in model_tickers]
+    nodes += [Node(f"chart:movingavg:{ticker}", 'chart', (f"raw:{ticker}",), _moving_average_chart(ticker))
+              for ticker in tickers]
+    return nodes
+
+
+def _take_lock(path):
+    """
+    the open lock file if this process got the exclusive lock on path, else None. the lock lasts until the file is
+    closed or the process exits, so a crashed leader frees it. without fcntl (windows) every process leads, run a
+    single worker or 'flask refresh' there
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return open(path, 'a')
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:   # another process holds it
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def read_state(path=None):
+    """the status the leading process last published, None if nothing was published yet"""
+    try:
+        with open(path or STATE_PATH, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def next_run_time(now=None):
+    """the next weekday MARKET_CLOSE + DELAY_MINUTES in New York after now"""
+    import stock_cache
+    now = now.astimezone(stock_cache.MARKET_TZ) if now else datetime.now(stock_cache.MARKET_TZ)
+    day = now.date()
+    while True:
+        run_at = datetime.combine(day, stock_cache.MARKET_CLOSE, tzinfo=stock_cache.MARKET_TZ) \
+            + timedelta(minutes=DELAY_MINUTES)
+        if day.weekday() < 5 and run_at > now:
+            return run_at
+        day += timedelta(days=1)
+
+
+class Scheduler:
+    """
+    runs the DAG with a thread pool, independent nodes in parallel. raw nodes share at most CALLS_PER_MINUTE slots,
+    since each may wait on the API quota. results and per node status stay in memory for the pages and /jobs
+    """
+    def __init__(self, tickers, model_tickers=(), max_workers=MAX_WORKERS):
+        from api_limit_checking import CALLS_PER_MINUTE
+        self.nodes = {node.name: node for node in build_graph(list(tickers), list(model_tickers))}
+        self.max_workers = max_workers
+        self._fetch_slots = threading.Semaphore(max(min(CALLS_PER_MINUTE, max_workers), 1))
+        self._results = {}   # node name -> Result of its last successful build
+        self._status = {name: {'kind': node.kind, 'state': 'pending'} for name, node in self.nodes.items()}
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()   # one pass at a time
+        self._publish_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock_file = None   # held while this process is the one scheduling
+        self.last_run = None
+        self.next_run = None
+
+    @property
+    def leader(self):
+        return self._lock_file is not None
+
+    def acquire_leadership(self):
+        """try to become the process that schedules, True if this process is (now) it"""
+        if self._lock_file is None:
+            self._lock_file = _take_lock(LOCK_PATH)
+        return self.leader
+
+    def artifact(self, name, default=None):
+        """
+        latest built artifact of a node (dataframe or ModelEntry), default if never built or if this process isn't
+        the leader, whose artifacts live in its own memory
+        """
+        if not self.leader:
+            return default
+        with self._lock:
+            result = self._results.get(name)
+        return default if result is None else result.artifact
+
+    def status(self):
+        """json friendly state of the scheduler and every node, as published by the leader when this isn't it"""
+        if not self.leader:
+            return dict(read_state() or {}, role='standby', pid=os.getpid())
+        with self._lock:
+            return self._status_locked()
+
+    def _status_locked(self):
+        return {
+            'role': 'leader',
+            'pid': os.getpid(),
+            'running': self._run_lock.locked(),
+            'last_run': dict(self.last_run) if self.last_run else None,
+            'next_run': self.next_run.isoformat() if self.next_run else None,
+            'nodes': {name: dict(status) for name, status in self._status.items()},
+        }
+
+    def _publish(self):
+        """write the status for the other worker processes, atomically"""
+        with self._publish_lock:   # node threads publish concurrently, one write at a time keeps the newest last
+            with self._lock:
+                state = self._status_locked()
+            tmp_path = f"{STATE_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(state, file)
+            os.replace(tmp_path, STATE_PATH)
+
+    def _set_status(self, name, **fields):
+        with self._lock:
+            self._status[name].update(fields)
+        self._publish()
+
+    def _run_node(self, node, inputs, versions):
+        """build node if its inputs changed, returns the state it ended in"""
+        previous = self._results.get(node.name)
+        if node.deps and previous is not None and previous.inputs == versions:
+            self._set_status(node.name, state='unchanged')
+            return 'unchanged'
+        self._set_status(node.name, state='running', error=None)
+        start = time.perf_counter()
+        try:
+            with span('scheduler_node', kind=node.kind):
+                if node.kind == 'raw':
+                    with self._fetch_slots:
+                        version, artifact = node.build(inputs)
+                else:
+                    version, artifact = node.build(inputs)
+        except Exception as error:   # keep the previous artifact, the pages keep serving it
+            inc('stockanalyzer_scheduler_nodes_total', kind=node.kind, state='failed')
+            self._set_status(node.name, state='failed', error=f"{type(error).__name__}: {error}",
+                             seconds=round(time.perf_counter() - start, 3))
+            return 'failed'
+        version = versions if version is None else version   # derived nodes are versioned by their inputs
+        state = 'built' if previous is None or previous.version != version else 'unchanged'
+        with self._lock:
+            self._results[node.name] = Result(version, artifact, versions)
+        inc('stockanalyzer_scheduler_nodes_total', kind=node.kind, state=state)
+        self._set_status(node.name, state=state, version=str(version), seconds=round(time.perf_counter() - start, 3),
+                         finished_at=datetime.now().isoformat(timespec='seconds'))
+        return state
+
+    def run(self):
+        """
+        one pass over the whole DAG, blocks until every node finished, returns {state: count}. only call it on the
+        leader (see acquire_leadership), or two processes fetch and render the same things
+        """
+        with self._run_lock:
+            started = datetime.now()
+            with self._lock:
+                for status in self._status.values():
+                    status['state'] = 'pending'
+            states = {}
+            remaining = dict(self.nodes)
+            running = {}
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scheduler') as pool:
+                while remaining or running:
+                    for name, node in list(remaining.items()):
+                        if any(dep in remaining or dep in running.values() for dep in node.deps):
+                            continue   # waits for its inputs
+                        del remaining[name]
+                        if any(states.get(dep) in ('failed', 'blocked') for dep in node.deps):
+                            states[name] = 'blocked'
+                            self._set_status(name, state='blocked', error="an input failed")
+                            continue
+                        inputs = {dep: self._results[dep].artifact for dep in node.deps}
+                        versions = tuple(self._results[dep].version for dep in node.deps)
+                        running[pool.submit(self._run_node, node, inputs, versions)] = name
+                    if not running:
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        states[running.pop(future)] = future.result()
+
+            counts = {}
+            for state in states.values():
+                counts[state] = counts.get(state, 0) + 1
+            with self._lock:
+                self.last_run = {'started': started.isoformat(timespec='seconds'),
+                                 'finished': datetime.now().isoformat(timespec='seconds'), **counts}
+            self._publish()
+            return counts
+
+    def _loop(self, run_now):
+        while not self.acquire_leadership():   # another worker schedules, take over if it goes away
+            if self._stopped.wait(STANDBY_SECONDS):
+                return
+        if run_now:
+            self.run()
+        while not self._stopped.is_set():
+            self.next_run = next_run_time()
+            self._publish()
+            delay = (self.next_run - datetime.now(self.next_run.tzinfo)).total_seconds()
+            self._wake.wait(max(delay, 0))
+            self._wake.clear()
+            if not self._stopped.is_set():
+                self.run()
+
+    def start(self, run_now=True):
+        """run in a daemon thread: once now (unless run_now=False), then after every market close"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, args=(run_now,), daemon=True, name='scheduler')
+            self._thread.start()
+        return self
+
+    def trigger(self):
+        """start a pass right away instead of waiting for the next close"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._lock_file is not None:
+            self._lock_file.close()   # frees the lock for a standby process
+            self._lock_file = None
+
+
+_default = None   # the app's scheduler, see start
+
+
+def start(tickers, model_tickers=(), run_now=True):
+    """create and start the process wide scheduler (once), returns it"""
+    global _default
+    if _default is None:
+        _default = Scheduler(tickers, model_tickers).start(run_now=run_now)
+    return _default
+
+
+def artifact(name, default=None):
+    """latest artifact of a node from the running scheduler, default when there is none (yet)"""
+    return default if _default is None else _default.artifact(name, default)
+
+
+def status():
+    """scheduler state for /jobs"""
+    if _default is None:
+        return {'enabled': False}
+    return dict(_default.status(), enabled=True)
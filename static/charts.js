@@ -0,0 +1,178 @@
+// draws the charts served by the /api endpoints on <canvas class="chart" data-src=... data-kind=...>:
+// line (data-series names the columns), heatmap (/api/correlation), bar (/api/stdev) and scatter (/api/linreg)
+// the server downsamples to the canvas width, so the browser only ever gets what it can show
+(function () {
+    const COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd'];
+    const PAD = {left: 70, right: 20, top: 40, bottom: 40};
+
+    // white background, the title, and the plot area inside the padding
+    function frame(canvas, title) {
+        const ctx = canvas.getContext('2d');
+        ctx.fillStyle = '#ffffff';
+        ctx.fillRect(0, 0, canvas.width, canvas.height);
+        ctx.fillStyle = '#000000';
+        ctx.font = '16px sans-serif';
+        ctx.fillText(title, PAD.left, 24);
+        ctx.font = '12px sans-serif';
+        return {ctx, width: canvas.width - PAD.left - PAD.right, height: canvas.height - PAD.top - PAD.bottom};
+    }
+
+    function range(arrays) {
+        let min = Infinity, max = -Infinity;
+        arrays.forEach(values => values.forEach(v => {
+            if (v !== null) { min = Math.min(min, v); max = Math.max(max, v); }
+        }));
+        return [min, max];
+    }
+
+    // y axis labels and grid, returns the value -> pixel function
+    function yAxis(ctx, width, height, min, max, decimals) {
+        const y = v => PAD.top + (max === min ? 0.5 : (max - v) / (max - min)) * height;
+        ctx.strokeStyle = '#dddddd';
+        for (let step = 0; step <= 4; step++) {
+            const value = min + (max - min) * step / 4;
+            ctx.beginPath();
+            ctx.moveTo(PAD.left, y(value));
+            ctx.lineTo(PAD.left + width, y(value));
+            ctx.stroke();
+            ctx.fillStyle = '#000000';
+            ctx.fillText(value.toFixed(decimals), 5, y(value) + 4);
+        }
+        return y;
+    }
+
+    function drawLine(canvas, data) {
+        const series = canvas.dataset.series.split(',');
+        const dates = data.dates;
+        const {ctx, width, height} = frame(canvas, canvas.dataset.title || data.ticker);
+        const [min, max] = range(series.map(name => data[name]));
+        const x = i => PAD.left + (dates.length > 1 ? i / (dates.length - 1) : 0) * width;
+        const y = yAxis(ctx, width, height, min, max, 2);
+
+        // a label on the first point of every 5th year
+        let lastYear = null;
+        dates.forEach((date, i) => {
+            const year = date.slice(0, 4);
+            if (year !== lastYear && Number(year) % 5 === 0) {
+                ctx.fillText(year, x(i) - 14, PAD.top + height + 20);
+            }
+            lastYear = year;
+        });
+
+        series.forEach((name, s) => {
+            ctx.strokeStyle = COLORS[s % COLORS.length];
+            ctx.lineWidth = 1.5;
+            ctx.beginPath();
+            let drawing = false;
+            data[name].forEach((v, i) => {
+                if (v === null) { drawing = false; return; }
+                drawing ? ctx.lineTo(x(i), y(v)) : ctx.moveTo(x(i), y(v));
+                drawing = true;
+            });
+            ctx.stroke();
+            ctx.fillStyle = COLORS[s % COLORS.length];
+            ctx.fillText(name, PAD.left + width - 180, PAD.top + 16 * (s + 1));
+        });
+    }
+
+    // blue for -1, white for 0, red for 1 (matplotlib's coolwarm, roughly)
+    function coolwarm(v) {
+        const t = Math.max(-1, Math.min(1, v));
+        const mix = (from, to) => Math.round(from + (to - from) * Math.abs(t));
+        return t < 0 ? `rgb(${mix(247, 59)},${mix(247, 76)},${mix(247, 192)})`
+                     : `rgb(${mix(247, 180)},${mix(247, 4)},${mix(247, 38)})`;
+    }
+
+    function drawHeatmap(canvas, data) {
+        const {ctx, width, height} = frame(canvas, canvas.dataset.title || 'Correlation');
+        const n = data.tickers.length;
+        const cell = Math.min(width, height) / n;
+        ctx.textAlign = 'center';
+        data.matrix.forEach((row, i) => row.forEach((v, j) => {
+            const left = PAD.left + j * cell, top = PAD.top + i * cell;
+            ctx.fillStyle = v === null ? '#eeeeee' : coolwarm(v);
+            ctx.fillRect(left, top, cell, cell);
+            ctx.fillStyle = '#000000';
+            ctx.fillText(v === null ? '' : v.toFixed(2), left + cell / 2, top + cell / 2 + 4);
+        }));
+        data.tickers.forEach((ticker, i) => {
+            ctx.fillText(ticker, PAD.left + i * cell + cell / 2, PAD.top + n * cell + 16);
+        });
+        ctx.textAlign = 'right';
+        data.tickers.forEach((ticker, i) => ctx.fillText(ticker, PAD.left - 6, PAD.top + i * cell + cell / 2 + 4));
+        ctx.textAlign = 'start';
+    }
+
+    function drawBar(canvas, data) {
+        const values = data[canvas.dataset.series || 'stdev'];
+        const {ctx, width, height} = frame(canvas, canvas.dataset.title || 'Standard Deviation');
+        const [, max] = range([values]);
+        const y = yAxis(ctx, width, height, 0, max, 4);
+        const slot = width / values.length;
+        ctx.textAlign = 'center';
+        values.forEach((v, i) => {
+            const left = PAD.left + i * slot;
+            if (v !== null) {
+                ctx.fillStyle = COLORS[i % COLORS.length];
+                ctx.fillRect(left + slot * 0.15, y(v), slot * 0.7, PAD.top + height - y(v));
+            }
+            ctx.fillStyle = '#000000';
+            ctx.fillText(data.tickers[i], left + slot / 2, PAD.top + height + 20);
+        });
+        ctx.textAlign = 'start';
+    }
+
+    // least squares y = c0 + c1 x + c2 x^2 (the order 2 fit the old regplot drew), by Cramer's rule
+    function quadraticFit(xs, ys) {
+        const s = [0, 0, 0, 0, 0], t = [0, 0, 0];
+        xs.forEach((x, i) => {
+            for (let p = 0; p < 5; p++) s[p] += x ** p;
+            for (let p = 0; p < 3; p++) t[p] += ys[i] * x ** p;
+        });
+        const det = m => m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1])
+            - m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0]) + m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0]);
+        const a = [[s[0], s[1], s[2]], [s[1], s[2], s[3]], [s[2], s[3], s[4]]];
+        const d = det(a);
+        if (!d) return null;
+        return [0, 1, 2].map(c => det(a.map((row, r) => row.map((v, k) => (k === c ? t[r] : v)))) / d);
+    }
+
+    function drawScatter(canvas, data) {
+        const {ctx, width, height} = frame(canvas, canvas.dataset.title || `${data.ticker} Linear Regression`);
+        const points = data.x.map((x, i) => [x, data.y[i]]).filter(([x, y]) => x !== null && y !== null);
+        const [xMin, xMax] = range([points.map(p => p[0])]);
+        const [yMin, yMax] = range([points.map(p => p[1])]);
+        const x = v => PAD.left + (xMax === xMin ? 0.5 : (v - xMin) / (xMax - xMin)) * width;
+        const y = yAxis(ctx, width, height, yMin, yMax, 3);
+        for (let step = 0; step <= 4; step++) {
+            const value = xMin + (xMax - xMin) * step / 4;
+            ctx.fillText(value.toFixed(1), x(value) - 12, PAD.top + height + 20);
+        }
+
+        ctx.fillStyle = 'rgba(31, 119, 180, 0.5)';
+        points.forEach(([px, py]) => ctx.fillRect(x(px) - 1.5, y(py) - 1.5, 3, 3));
+
+        // fitted on a centred x, raw prices squared lose too much precision
+        const mid = (xMin + xMax) / 2;
+        const fit = quadraticFit(points.map(p => p[0] - mid), points.map(p => p[1]));
+        if (fit) {
+            ctx.strokeStyle = COLORS[1];
+            ctx.lineWidth = 2;
+            ctx.beginPath();
+            for (let step = 0; step <= 100; step++) {
+                const px = xMin + (xMax - xMin) * step / 100, dx = px - mid;
+                const py = Math.max(yMin, Math.min(yMax, fit[0] + fit[1] * dx + fit[2] * dx * dx));
+                step ? ctx.lineTo(x(px), y(py)) : ctx.moveTo(x(px), y(py));
+            }
+            ctx.stroke();
+        }
+    }
+
+    const DRAW = {line: drawLine, heatmap: drawHeatmap, bar: drawBar, scatter: drawScatter};
+
+    document.querySelectorAll('canvas.chart').forEach(canvas => {
+        const url = new URL(canvas.dataset.src, window.location.href);
+        url.searchParams.set('points', canvas.width);
+        fetch(url).then(response => response.json()).then(data => DRAW[canvas.dataset.kind || 'line'](canvas, data));
+    });
+})();
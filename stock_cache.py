@@ -0,0 +1,211 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+from indicators import IndicatorState, indicator_frame
+
+try:
+    import fcntl
+except ImportError:   # windows, only the threads of one process are kept apart there
+    fcntl = None
+
+# one folder per ticker holding one .npy file per column, so a cache hit is a handful of small binary reads
+CACHE_DIR = os.getenv('STOCK_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stock_cache'))
+COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+INDICATOR_FILES = ['daily_returns', 'sma_20', 'prev_close']   # stored in the order of indicators.INDICATOR_COLUMNS
+MARKET_TZ = ZoneInfo('America/New_York')
+MARKET_CLOSE = time(16, 30)  # AlphaVantage publishes the daily bar a little after the 16:00 close
+COMPACT_BARS = 100  # outputsize=compact returns the latest 100 bars
+TICKER_PATTERN = re.compile(r'^[A-Z0-9][A-Z0-9.\-]{0,14}$')   # also keeps ticker folders inside CACHE_DIR
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def ticker_lock(ticker):
+    """
+    held while a ticker is checked, fetched and saved: a thread lock for this process plus an flock on a file in the
+    ticker's folder for the other worker processes, so a stale ticker only triggers one download and one write
+    """
+    with _locks_guard:
+        lock = _locks.setdefault(ticker, threading.Lock())
+    with lock:
+        folder = _ticker_dir(ticker)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)   # released when the file is closed
+            yield
+
+
+def last_trading_day(now=None):
+    """most recent weekday whose session has closed (in New York time)"""
+    now = now.astimezone(MARKET_TZ) if now else datetime.now(MARKET_TZ)
+    day = now.date()
+    if now.time() < MARKET_CLOSE:   # today's bar isn't out yet
+        day -= timedelta(days=1)
+    while day.weekday() >= 5:   # skip saturday and sunday
+        day -= timedelta(days=1)
+    return day
+
+
+def is_valid_ticker(ticker):
+    """symbols like JPM, BRK.B or RDS-A"""
+    return bool(TICKER_PATTERN.match(ticker.upper()))
+
+
+def _ticker_dir(ticker):
+    if not is_valid_ticker(ticker):
+        raise ValueError(f"invalid ticker {ticker!r}")
+    return os.path.join(CACHE_DIR, ticker.upper())
+
+
+def read_meta(ticker):
+    """returns the metadata dict for a cached ticker, or None if it isn't cached"""
+    try:
+        with open(os.path.join(_ticker_dir(ticker), 'meta.json'), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_meta(ticker, meta):
+    path = os.path.join(_ticker_dir(ticker), 'meta.json')
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, path)   # atomic swap so readers never see a half written file
+
+
+def _save_column(path, values):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        np.save(file, values)
+    os.replace(tmp_path, path)   # a reader never opens a column that is still being written
+
+
+def load(ticker):
+    """read cached bars for ticker as a dataframe, or None if nothing is cached"""
+    for _ in range(2):   # retry once in case a writer swapped generations between reading meta and the columns
+        meta = read_meta(ticker)
+        if meta is None:
+            return None
+        folder = _ticker_dir(ticker)
+        generation = meta['generation']
+        try:
+            dates = np.load(os.path.join(folder, f"date.{generation}.npy"))
+            columns = {name: np.load(os.path.join(folder, f"{name}.{generation}.npy")) for name in COLUMNS}
+        except FileNotFoundError:
+            continue
+        df = pd.DataFrame(columns, index=pd.DatetimeIndex(dates))
+        return df
+    return None
+
+
+def load_indicators(ticker):
+    """cached daily returns, 20 day moving average and previous close for ticker, or None if nothing is cached"""
+    for _ in range(2):
+        meta = read_meta(ticker)
+        if meta is None:
+            return None
+        folder = _ticker_dir(ticker)
+        generation = meta['generation']
+        try:
+            dates = np.load(os.path.join(folder, f"date.{generation}.npy"))
+            values = np.column_stack([np.load(os.path.join(folder, f"{name}.{generation}.npy"))
+                                      for name in INDICATOR_FILES])
+        except FileNotFoundError:
+            continue
+        return indicator_frame(values, pd.DatetimeIndex(dates))
+    return None
+
+
+def save(ticker, df, checked_at=None, indicators=None):
+    """
+    write the full bar history for ticker, replacing whatever was cached. indicators is an
+    (IndicatorState, values) pair already covering df, without it the indicators are replayed from the first bar.
+    hold ticker_lock(ticker) around it when other processes may write the same ticker
+    """
+    folder = _ticker_dir(ticker)
+    os.makedirs(folder, exist_ok=True)
+    old_meta = read_meta(ticker)
+    generation = (old_meta['generation'] + 1) if old_meta else 0
+    if indicators is None:
+        state = IndicatorState()
+        indicators = (state, state.update_many(df['close'].to_numpy(dtype=np.float64)))
+    state, indicator_values = indicators
+
+    _save_column(os.path.join(folder, f"date.{generation}.npy"), df.index.values.astype('datetime64[D]'))
+    for name in COLUMNS:
+        _save_column(os.path.join(folder, f"{name}.{generation}.npy"), df[name].to_numpy())
+    for position, name in enumerate(INDICATOR_FILES):
+        _save_column(os.path.join(folder, f"{name}.{generation}.npy"), indicator_values[:, position])
+
+    checked_at = checked_at or datetime.now(MARKET_TZ)
+    _write_meta(ticker, {
+        'generation': generation,
+        'rows': len(df),
+        'last_bar': df.index[-1].strftime('%Y-%m-%d') if len(df) else None,
+        'checked_at': checked_at.isoformat(),
+        'indicators': state.to_dict(),   # checkpoint so the next append only updates the new bars
+    })
+
+    if old_meta:   # drop the previous generation now that meta points at the new one
+        for name in ['date'] + COLUMNS + INDICATOR_FILES:
+            try:
+                os.remove(os.path.join(folder, f"{name}.{old_meta['generation']}.npy"))
+            except FileNotFoundError:
+                pass
+
+
+def append(ticker, new_bars, checked_at=None):
+    """merge freshly downloaded bars onto the cached history and return the combined dataframe"""
+    meta = read_meta(ticker)
+    cached = load(ticker)
+    cached_indicators = load_indicators(ticker)
+    if cached is None or not len(cached) or cached_indicators is None or 'indicators' not in meta:
+        save(ticker, new_bars, checked_at=checked_at)
+        return new_bars
+
+    new_bars = new_bars[new_bars.index > cached.index[-1]]   # only keep the missing tail
+    combined = pd.concat([cached, new_bars]) if len(new_bars) else cached
+    state = IndicatorState.from_dict(meta['indicators'])   # resume from the checkpoint, O(1) per new bar
+    new_values = state.update_many(new_bars['close'].to_numpy(dtype=np.float64))
+    indicator_values = np.vstack([cached_indicators.to_numpy(), new_values])
+    save(ticker, combined, checked_at=checked_at, indicators=(state, indicator_values))
+    return combined
+
+
+def is_stale(ticker, now=None):
+    """
+    a ticker is fresh if it has the bar for the latest closed trading day, or if we already
+    asked the API after that session closed (covers market holidays where no new bar exists)
+    """
+    meta = read_meta(ticker)
+    if meta is None or meta['last_bar'] is None:
+        return True
+    expected = last_trading_day(now)
+    if datetime.strptime(meta['last_bar'], '%Y-%m-%d').date() >= expected:
+        return False
+    checked_at = datetime.fromisoformat(meta['checked_at'])
+    expected_close = datetime.combine(expected, MARKET_CLOSE, tzinfo=MARKET_TZ)
+    return checked_at < expected_close
+
+
+def outputsize_needed(ticker, now=None):
+    """'compact' if the missing tail fits inside the last 100 bars, else 'full'"""
+    meta = read_meta(ticker)
+    if meta is None or meta['last_bar'] is None:
+        return 'full'
+    last_bar = np.datetime64(meta['last_bar'], 'D')
+    expected = np.datetime64(last_trading_day(now), 'D')
+    missing = np.busday_count(last_bar + 1, expected + 1)   # weekdays we don't have yet
+    return 'compact' if missing < COMPACT_BARS else 'full'
@@ -0,0 +1,183 @@
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from returns_panel import ReturnsPanel
+
+# the whole ticker universe in one folder: dates.<generation>.npy holds the shared (sorted) calendar, every column
+# in COLUMNS is one (dates x tickers) .npy matrix, and meta.json lists the tickers in column order. Readers memory map
+# the matrices, so every worker process shares the same pages from the OS page cache instead of its own copy
+UNIVERSE_DIR = os.getenv('STOCK_UNIVERSE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'universe_store'))
+COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+BLOCK_TICKERS = 256   # tickers assembled in memory at a time while writing, keeps the writes to the store sequential
+
+_open_stores = {}   # path -> UniverseStore, reopened when a new generation is written
+_open_guard = threading.Lock()
+
+
+def read_meta(path=None):
+    """metadata of the store at path (default UNIVERSE_DIR), or None if there is no store"""
+    try:
+        with open(os.path.join(path or UNIVERSE_DIR, 'meta.json'), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_meta(path, meta):
+    meta_path = os.path.join(path, 'meta.json')
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, meta_path)   # atomic swap, readers see either the old or the new generation
+
+
+class UniverseStore:
+    """
+    read only, memory mapped view of the store. tickers are the columns, dates the rows, a ticker without a bar on
+    some date has NaN prices and 0 volume there
+    """
+    def __init__(self, path=None):
+        self.path = path or UNIVERSE_DIR
+        for _ in range(2):   # retry once in case a writer swapped generations between reading meta and the files
+            meta = read_meta(self.path)
+            if meta is None:
+                raise FileNotFoundError(f"no universe store in {self.path}")
+            try:
+                dates = np.load(self._file('dates', meta['generation']))
+                self.columns = {name: np.load(self._file(name, meta['generation']), mmap_mode='r')
+                                for name in COLUMNS}
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            raise FileNotFoundError(f"universe store in {self.path} changed while opening it")
+        self.meta = meta
+        self.generation = meta['generation']
+        self.tickers = list(meta['tickers'])
+        self.positions = {ticker: position for position, ticker in enumerate(self.tickers)}
+        self.dates = pd.DatetimeIndex(dates)
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, f"{name}.{generation}.npy")
+
+    def __contains__(self, ticker):
+        return ticker in self.positions
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def column(self, name, tickers=None):
+        """(dates x tickers) matrix of one column, the memory map itself for all tickers, else a copy of the subset"""
+        matrix = self.columns[name]
+        if tickers is None:
+            return matrix
+        return matrix[:, [self.positions[ticker] for ticker in tickers]]
+
+    def frame(self, ticker):
+        """the ticker's bars as a dataframe shaped like data.get_stock_df, only the dates it has a close for"""
+        position = self.positions[ticker]
+        close = np.asarray(self.columns['close'][:, position])
+        have = ~np.isnan(close)
+        data = {name: np.asarray(self.columns[name][:, position])[have] for name in COLUMNS}
+        return pd.DataFrame(data, index=self.dates[have], columns=COLUMNS)
+
+    def frames(self, tickers=None):
+        """{ticker: dataframe} for tickers (default all of them), for code written against get_multiple_stock_df"""
+        return {ticker: self.frame(ticker) for ticker in (self.tickers if tickers is None else tickers)}
+
+    def returns_panel(self, tickers=None):
+        """ReturnsPanel of the tickers (default all), the close matrix is used in place when it's already float64"""
+        tickers = self.tickers if tickers is None else list(tickers)
+        return ReturnsPanel(tickers, self.dates, self.column('close', None if tickers == self.tickers else tickers))
+
+
+def open_store(path=None):
+    """the store at path (default UNIVERSE_DIR) shared by every caller in this process, None if there is none"""
+    path = path or UNIVERSE_DIR
+    meta = read_meta(path)
+    if meta is None:
+        return None
+    with _open_guard:
+        store = _open_stores.get(path)
+        if store is None or store.generation != meta['generation']:
+            store = _open_stores[path] = UniverseStore(path)
+        return store
+
+
+def write_store(items, path=None, price_dtype='float64', replace=False):
+    """
+    build a new generation of the store from items, an iterable of (ticker, dates, {column: array}) like
+    av_parser.parse_series returns. tickers already in the store are kept (unless replace) and a ticker seen again
+    overwrites its old history. Parsed items are spilled to disk first, so memory stays at one block of tickers
+    no matter how large the universe is. Returns the new metadata
+    """
+    path = path or UNIVERSE_DIR
+    os.makedirs(path, exist_ok=True)
+    old = None if replace or read_meta(path) is None else UniverseStore(path)
+    old_meta = read_meta(path)
+    generation = old_meta['generation'] + 1 if old_meta else 0
+
+    with tempfile.TemporaryDirectory(dir=path, prefix='ingest-') as spill:
+        spilled = {}
+        dates = np.empty(0, dtype='datetime64[D]')
+        for ticker, ticker_dates, columns in items:
+            file_path = os.path.join(spill, f"{len(spilled)}.npz")
+            np.savez(file_path, dates=ticker_dates, **columns)
+            spilled[ticker] = file_path   # a later file for the same ticker wins
+            dates = np.union1d(dates, ticker_dates.astype('datetime64[D]'))
+
+        kept = [ticker for ticker in old.tickers if ticker not in spilled] if old else []
+        if kept:
+            dates = np.union1d(dates, old.dates.values.astype('datetime64[D]'))
+        tickers = sorted(kept + list(spilled))
+        old_rows = np.searchsorted(dates, old.dates.values.astype('datetime64[D]')) if kept else None
+
+        dtypes = {name: np.int64 if name == 'volume' else np.dtype(price_dtype) for name in COLUMNS}
+        matrices = {name: np.lib.format.open_memmap(os.path.join(path, f"{name}.{generation}.npy"), mode='w+',
+                                                    dtype=dtypes[name], shape=(len(dates), len(tickers)))
+                    for name in COLUMNS}
+        for start in range(0, len(tickers), BLOCK_TICKERS):
+            block_tickers = tickers[start:start + BLOCK_TICKERS]
+            blocks = {name: np.full((len(dates), len(block_tickers)), 0 if name == 'volume' else np.nan,
+                                    dtype=dtypes[name]) for name in COLUMNS}
+            for offset, ticker in enumerate(block_tickers):
+                if ticker in spilled:
+                    with np.load(spilled[ticker]) as saved:
+                        rows = np.searchsorted(dates, saved['dates'].astype('datetime64[D]'))
+                        for name in COLUMNS:
+                            blocks[name][rows, offset] = saved[name]
+                else:
+                    position = old.positions[ticker]
+                    for name in COLUMNS:
+                        blocks[name][old_rows, offset] = old.columns[name][:, position]
+            for name in COLUMNS:
+                matrices[name][:, start:start + len(block_tickers)] = blocks[name]
+        for matrix in matrices.values():
+            matrix.flush()
+        del matrices
+        np.save(os.path.join(path, f"dates.{generation}.npy"), dates)
+
+    meta = {
+        'generation': generation,
+        'tickers': tickers,
+        'rows': len(dates),
+        'first_date': str(dates[0]) if len(dates) else None,
+        'last_date': str(dates[-1]) if len(dates) else None,
+        'price_dtype': np.dtype(price_dtype).name,
+        'built_at': datetime.now(timezone.utc).isoformat(),
+    }
+    _write_meta(path, meta)
+    if old_meta:   # readers that already mapped the old files keep them until they close, the OS handles that
+        for name in ['dates'] + COLUMNS:
+            try:
+                os.remove(os.path.join(path, f"{name}.{old_meta['generation']}.npy"))
+            except FileNotFoundError:
+                pass
+    return meta